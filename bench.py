@@ -0,0 +1,578 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for the bootstrap tooling.
+
+> ./bench.py
+
+Runs bootstrap(), copy_dotfiles and each installer against stand-ins for
+the outside world, so it works on any Linux machine without network access
+or a Fedora install:
+
+- fake `dnf`, `rpm`, `sudo`, `git`, `npm`, `go`, `pip`, `mise`, `fc-cache`
+  (and friends) executables are put first on the PATH, each sleeping for a
+  configurable latency
+- a local HTTP server stands in for the GitHub releases API, the release
+  assets, the nerd fonts zips and the fontsource API/CDN
+- synthetic `home/` trees with 10 to 100k files are generated for the
+  dotfile benchmarks
+- a synthetic system font directory, which the fake `fc-cache` reads in
+  full when it is run without arguments, to compare updating only the
+  changed font directories against a full rescan
+- a bundle (see bundle.py) built from the local HTTP server, then used
+  to install the fonts and GitHub rpms without the server
+- a nerd font zip of several hundred MiB, to check that installing it
+  keeps peak memory bounded (the scenario fails above LARGE_FONT_RSS_LIMIT)
+
+Each scenario runs in its own child process with HOME pointed at a scratch
+directory, and the wall time and peak RSS of that process are reported.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import platform
+import pwd
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from yaml import safe_load
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Served as a nerd font release asset, next to the fonts from bootstrap.yaml
+LARGE_FONT = "BenchLargeFont"
+# Number of font files the large zip is split into
+LARGE_FONT_MEMBERS = 8
+# Peak RSS (MiB) the large font install has to stay under, however big the zip is
+LARGE_FONT_RSS_LIMIT = 128
+# Where the bundle scenarios write and read their bundle, relative to the workdir
+BENCH_BUNDLE = "dots-bundle.tar"
+
+# name -> shell script body. Every fake sleeps for $DOTS_BENCH_LATENCY first.
+FAKE_TOOLS = {
+    # Only hand off to other fakes, anything else (mv into /etc, ...) is a no-op
+    "sudo": 'case "$1" in dnf|rpm|chsh) exec "$@";; esac\nexit 0',
+    "dnf": "exit 0",
+    # Report every queried capability as missing
+    "rpm": 'for arg in "$@"; do case "$arg" in -*) ;; *) echo "no package provides $arg";; esac; done\nexit 1',
+    "git": 'if [ "$1" = "clone" ]; then for last; do :; done; mkdir -p "$last/.git"; fi\nexit 0',
+    "npm": "exit 0",
+    "go": "exit 0",
+    "pip": "exit 0",
+    "mise": "exit 0",
+    # Read every file it would scan, with no arguments that is every font directory
+    "fc-cache": 'if [ $# -eq 0 ]; then set -- "$DOTS_BENCH_SYSTEM_FONTS" "$HOME/.local/share/fonts"; fi\n'
+    'find "$@" -type f -exec cat {} + > /dev/null 2>&1\nexit 0',
+    "chsh": "exit 0",
+    "curl": "exit 0",
+    "zsh": "exit 0",
+}
+
+
+def write_fake_tools(bin_dir: str):
+    """
+    Create the fake executables.
+
+    :param bin_dir: Directory to put first on the PATH
+    :return:
+    """
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, body in FAKE_TOOLS.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            if name == "sudo":
+                f.write(f"#!/bin/sh\n{body}\n")
+            else:
+                f.write(f'#!/bin/sh\nsleep "${{DOTS_BENCH_LATENCY:-0}}"\n{body}\n')
+        os.chmod(path, 0o755)
+
+
+def write_zip(path: str, members: dict):
+    """
+    :param path: Where to write the zip
+    :param members: member name -> size in bytes of random content
+    :return:
+    """
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as zip_file:
+        for name, size in members.items():
+            with zip_file.open(name, "w") as f:
+                remaining = size
+                while remaining > 0:
+                    chunk = os.urandom(min(remaining, 1024 * 1024))
+                    f.write(chunk)
+                    remaining -= len(chunk)
+
+
+def fontsource_id(family: str) -> str:
+    return family.lower().replace(" ", "-")
+
+
+def build_artifacts(
+    data: dict, www: str, rpm_size: int, font_size: int, large_font_size: int = 0
+):
+    """
+    Generate every file the fake HTTP server hands out.
+
+    :param data: The loaded bootstrap.yaml
+    :param www: Directory to write the artifacts to
+    :param rpm_size: Size of each fake rpm in bytes
+    :param font_size: Size of each font file in the fake zips in bytes
+    :param large_font_size: (optional) Size in bytes of the LARGE_FONT zip, 0 to leave it out
+    :return:
+    """
+    os.makedirs(www, exist_ok=True)
+    if large_font_size:
+        # Random content doesn't compress, so the zip is as big as its members
+        write_zip(
+            os.path.join(www, f"nerd-{LARGE_FONT}.zip"),
+            {
+                f"{LARGE_FONT}NerdFont-{i}.ttf": large_font_size // LARGE_FONT_MEMBERS
+                for i in range(LARGE_FONT_MEMBERS)
+            },
+        )
+
+    for package in data["rpm_from_github"] or []:
+        with open(os.path.join(www, f"{package['repo']}.rpm"), "wb") as f:
+            f.write(os.urandom(rpm_size))
+
+    for font in data["fonts"].get("nerd") or []:
+        write_zip(
+            os.path.join(www, f"nerd-{font}.zip"),
+            {f"{font}NerdFont-Regular.ttf": font_size, "LICENSE": 100},
+        )
+
+    for family in data["fonts"].get("fontsource") or []:
+        font_id = fontsource_id(family)
+        write_zip(
+            os.path.join(www, f"fontsource-{font_id}.zip"),
+            {
+                f"ttf/{font_id}-latin-400-normal.ttf": font_size,
+                f"ttf/{font_id}-cyrillic-400-normal.ttf": font_size,
+                "LICENSE": 100,
+            },
+        )
+
+
+def start_server(www: str, latency: float) -> ThreadingHTTPServer:
+    """
+    Serve the fake GitHub, nerd fonts and fontsource endpoints.
+
+    :param www: Directory with the generated artifacts
+    :param latency: Seconds to wait before answering each request
+    :return: The running server
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def send_file(self, path: str):
+            if not os.path.exists(path):
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.end_headers()
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+
+        def send_json(self, data):
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            time.sleep(latency)
+            url = urlparse(self.path)
+            base = f"http://{self.headers['Host']}"
+
+            if match := re.fullmatch(r"/repos/([^/]+)/([^/]+)/releases/latest", url.path):
+                repo = match.group(2)
+                name = f"{repo}-1.0.0-1.{platform.machine().lower()}.rpm"
+                asset = os.path.join(www, f"{repo}.rpm")
+                assets = []
+                if os.path.exists(asset):
+                    with open(asset, "rb") as f:
+                        digest = hashlib.file_digest(f, "sha256").hexdigest()
+                    assets.append(
+                        {
+                            "name": name,
+                            "size": os.path.getsize(asset),
+                            "digest": f"sha256:{digest}",
+                            "browser_download_url": f"{base}/assets/{repo}/{name}",
+                        }
+                    )
+                self.send_json({"tag_name": "v1.0.0", "assets": assets})
+            elif match := re.fullmatch(r"/assets/([^/]+)/[^/]+\.rpm", url.path):
+                self.send_file(os.path.join(www, f"{match.group(1)}.rpm"))
+            elif match := re.fullmatch(r"/download/[^/]+/([^/]+)\.zip", url.path):
+                self.send_file(os.path.join(www, f"nerd-{match.group(1)}.zip"))
+            elif url.path == "/v1/fonts":
+                family = parse_qs(url.query)["family"][0]
+                self.send_json([{"id": fontsource_id(family), "family": family}])
+            elif match := re.fullmatch(r"/fonts/([^/@]+)@latest/download\.zip", url.path):
+                self.send_file(os.path.join(www, f"fontsource-{match.group(1)}.zip"))
+            else:
+                self.send_error(404)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def generate_home(path: str, files: int, file_size: int = 512):
+    """
+    Create a synthetic dotfiles tree.
+
+    Files are spread across nested directories, 100 to a directory.
+
+    :param path: Root of the tree to create
+    :param files: How many files to create
+    :param file_size: Size of each file in bytes
+    :return:
+    """
+    for i in range(files):
+        directory = os.path.join(path, ".config", f"app{i // 1000}", f"dir{i // 100 % 10}")
+        if i % 100 == 0:
+            os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"file{i}.conf"), "w") as f:
+            f.write(f"# synthetic dotfile {i}\n".ljust(file_size, "x"))
+
+
+def generate_system_fonts(path: str, files: int, file_size: int = 64 * 1024):
+    """
+    Create a stand-in for the system font directories, 20 fonts to a family.
+
+    :param path: Root of the tree to create
+    :param files: How many font files to create
+    :param file_size: Size of each file in bytes
+    :return:
+    """
+    for i in range(files):
+        directory = os.path.join(path, f"family{i // 20}")
+        if i % 20 == 0:
+            os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"font{i}.ttf"), "wb") as f:
+            f.write(os.urandom(file_size))
+
+
+# Child side: these run inside the scenario process
+
+
+def point_at_server(base_url: str):
+    """
+    Redirect every download to the fake HTTP server.
+
+    :param base_url: e.g. http://127.0.0.1:12345
+    :return:
+    """
+    import fonts
+    import packages
+
+    packages.GITHUB_API = base_url
+    fonts.GITHUB_API = base_url
+    fonts.NERD_FONTS_DOWNLOAD = f"{base_url}/download"
+    fonts.FONTSOURCE_API = f"{base_url}/v1"
+    fonts.FONTSOURCE_CDN = base_url
+
+
+def run_scenario(name: str, base_url: str, jobs: int):
+    sys.path.insert(0, REPO_DIR)
+    point_at_server(base_url)
+
+    from bootstrap import bootstrap, load_bootstrap_file
+
+    data = load_bootstrap_file("bootstrap.yaml")
+
+    if name == "bootstrap":
+        bootstrap(jobs=jobs)
+    elif name == "copy_dotfiles":
+        from dots import copy_dotfiles
+
+        copy_dotfiles("./home", os.path.expanduser("~"), jobs=jobs)
+    elif name == "fonts":
+        from fonts import install_fonts
+
+        install_fonts(data["fonts"], jobs=jobs)
+    elif name == "fonts_full_rescan":
+        import fonts
+        from utils import cmd
+
+        # How the font cache was updated before only changed directories were passed
+        fonts.update_font_cache = lambda dirs: cmd(["fc-cache"])
+        fonts.install_fonts(data["fonts"], jobs=jobs)
+    elif name == "large_font":
+        import resource
+
+        from fonts import install_nerd_font
+
+        ok, _ = install_nerd_font(LARGE_FONT, "v1.0.0")
+        if not ok:
+            raise Exception(f"Failed to install {LARGE_FONT}")
+        # ru_maxrss is in KiB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        if peak > LARGE_FONT_RSS_LIMIT:
+            raise Exception(
+                f"Peak RSS {peak:.1f}MiB is over {LARGE_FONT_RSS_LIMIT}MiB, "
+                "the font zip isn't being streamed"
+            )
+    elif name == "bundle_build":
+        from bundle import build_bundle
+
+        build_bundle(data, BENCH_BUNDLE, jobs=jobs)
+    elif name == "bundle_install":
+        import cache
+        from bundle import open_bundle
+        from fonts import install_fonts
+        from packages import DnfTransaction
+
+        cache.configure(bundle=open_bundle(BENCH_BUNDLE))
+        transaction = DnfTransaction()
+        for package in data["rpm_from_github"]:
+            transaction.add_rpm_from_github(
+                package["owner"], package["repo"], program_name=package.get("name")
+            )
+        transaction.download_rpms(jobs=jobs)
+        # Every bundled rpm has to make it into the dnf transaction
+        specs = transaction.specs()
+        dropped = [path for path in transaction.rpm_paths if path not in specs]
+        if len(transaction.rpm_paths) != len(data["rpm_from_github"]) or dropped:
+            raise Exception(
+                f"Only {len(specs)} of {len(data['rpm_from_github'])} bundled rpms "
+                f"would be installed: {transaction.rpm_paths}"
+            )
+        transaction.run()
+        if install_fonts(data["fonts"], jobs=jobs):
+            raise Exception("Failed to install fonts from the bundle")
+    elif name == "dnf":
+        from packages import DnfTransaction
+
+        transaction = DnfTransaction()
+        transaction.add_groups(data["groups"])
+        transaction.add_packages(data["packages"])
+        for package in data["rpm_from_github"]:
+            transaction.add_rpm_from_github(
+                package["owner"], package["repo"], program_name=package.get("name")
+            )
+        transaction.download_rpms(jobs=jobs)
+        transaction.run()
+    elif name == "mise":
+        from mise import mise_use_all
+
+        mise_use_all(data["mise"], jobs=jobs)
+    elif name == "npm":
+        from packages import install_npm_global_packages
+
+        install_npm_global_packages(data["npm_global"])
+    elif name == "go":
+        from packages import install_go_packages
+
+        install_go_packages(data["go_install"], jobs=jobs)
+    elif name == "pip":
+        from packages import install_pip_packages
+
+        install_pip_packages(data["pip_global"], user_scoped=True)
+    elif name == "repos":
+        from repos import download_repos
+
+        download_repos(data["repos"], jobs=jobs)
+    elif name == "git":
+        from git import setup_git
+
+        setup_git(data["git"])
+    else:
+        raise Exception(f"Unknown scenario {name}")
+
+
+# Parent side
+
+
+INSTALLERS = ["fonts", "dnf", "mise", "npm", "go", "pip", "repos", "git"]
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.root = tempfile.mkdtemp(prefix="dots-bench-")
+        self.bin_dir = os.path.join(self.root, "bin")
+        write_fake_tools(self.bin_dir)
+        self.system_fonts = os.path.join(self.root, "system-fonts")
+        generate_system_fonts(self.system_fonts, args.system_fonts)
+
+        with open(args.config, "r") as f:
+            self.data = safe_load(f)
+        www = os.path.join(self.root, "www")
+        build_artifacts(
+            self.data, www, args.rpm_size, args.font_size, args.large_font_size
+        )
+        self.server = start_server(www, args.http_latency)
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.results = []
+
+    def workdir(self, name: str, home_files: int = None) -> str:
+        """
+        Create a scratch directory holding bootstrap.yaml, a ./home tree and
+        an empty $HOME for a scenario.
+        """
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.join(path, "user-home", ".local", "bin"))
+        shutil.copy(self.args.config, os.path.join(path, "bootstrap.yaml"))
+        shutil.copy(
+            os.path.join(self.bin_dir, "mise"),
+            os.path.join(path, "user-home", ".local", "bin", "mise"),
+        )
+        if home_files is None:
+            shutil.copytree(os.path.join(REPO_DIR, "home"), os.path.join(path, "home"))
+        else:
+            generate_home(os.path.join(path, "home"), home_files)
+        return path
+
+    def run(self, label: str, scenario: str, workdir: str):
+        """
+        Run a scenario in a child process and record its wall time and peak RSS.
+        """
+        env = dict(
+            os.environ,
+            HOME=os.path.join(workdir, "user-home"),
+            PATH=f"{self.bin_dir}:{os.environ.get('PATH', '')}",
+            USER=pwd.getpwuid(os.getuid()).pw_name,
+            DOTS_BENCH_LATENCY=str(self.args.latency),
+            DOTS_BENCH_SYSTEM_FONTS=self.system_fonts,
+        )
+        output = None if self.args.verbose else subprocess.DEVNULL
+
+        start = time.monotonic()
+        proc = subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "--child",
+                scenario,
+                "--base-url",
+                self.base_url,
+                "--jobs",
+                str(self.args.jobs),
+            ],
+            cwd=workdir,
+            env=env,
+            stdout=output,
+            stderr=output,
+        )
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        wall = time.monotonic() - start
+
+        # ru_maxrss is in KiB on Linux
+        self.results.append((label, wall, usage.ru_maxrss / 1024, proc.returncode))
+        print(f"{label:<32} {wall:>8.2f}s {usage.ru_maxrss / 1024:>8.1f}MiB  exit {proc.returncode}")
+
+    def run_all(self):
+        print(f"{'scenario':<32} {'wall':>9} {'peak rss':>11}")
+
+        workdir = self.workdir("bootstrap")
+        self.run("bootstrap (cold)", "bootstrap", workdir)
+        self.run("bootstrap (warm)", "bootstrap", workdir)
+
+        for files in self.args.sizes:
+            workdir = self.workdir(f"dotfiles-{files}", home_files=files)
+            self.run(f"copy_dotfiles {files} files (cold)", "copy_dotfiles", workdir)
+            self.run(f"copy_dotfiles {files} files (warm)", "copy_dotfiles", workdir)
+
+        for installer in INSTALLERS:
+            self.run(installer, installer, self.workdir(f"installer-{installer}"))
+
+        # The warm runs skip every font, so fc-cache has nothing to do
+        workdir = self.workdir("fonts-full-rescan")
+        self.run("fonts, fc-cache rescan (cold)", "fonts_full_rescan", workdir)
+        self.run("fonts, fc-cache rescan (warm)", "fonts_full_rescan", workdir)
+        workdir = self.workdir("fonts-changed-dirs")
+        self.run("fonts, fc-cache changed (cold)", "fonts", workdir)
+        self.run("fonts, fc-cache changed (warm)", "fonts", workdir)
+
+        workdir = self.workdir("bundle")
+        self.run("bundle build", "bundle_build", workdir)
+        self.run("install from bundle", "bundle_install", workdir)
+
+        if self.args.large_font_size:
+            # Exits non-zero if the peak RSS goes over LARGE_FONT_RSS_LIMIT
+            size = self.args.large_font_size / 1024 / 1024
+            self.run(f"nerd font zip, {size:.0f}MiB", "large_font", self.workdir("large-font"))
+
+    def close(self):
+        self.server.shutdown()
+        if self.args.keep:
+            print(f"Kept scratch files in {self.root}")
+        else:
+            shutil.rmtree(self.root)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for dots.")
+    parser.add_argument("--config", default=os.path.join(REPO_DIR, "bootstrap.yaml"))
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.05,
+        help="Seconds each fake command sleeps for (default: 0.05)",
+    )
+    parser.add_argument(
+        "--http-latency",
+        type=float,
+        default=0.05,
+        help="Seconds the fake HTTP server waits before each response (default: 0.05)",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[10, 1000, 10000, 100000],
+        help="Comma separated file counts for the synthetic home trees",
+    )
+    parser.add_argument("--rpm-size", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--font-size", type=int, default=512 * 1024)
+    parser.add_argument(
+        "--large-font-size",
+        type=int,
+        default=384 * 1024 * 1024,
+        help="Size in bytes of the large nerd font zip, 0 to skip that scenario "
+        "(default: 384MiB)",
+    )
+    parser.add_argument(
+        "--system-fonts",
+        type=int,
+        default=500,
+        help="Number of font files in the synthetic system font directory (default: 500)",
+    )
+    parser.add_argument("-j", "--jobs", type=int, default=4)
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show scenario output")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.child:
+        run_scenario(args.child, args.base_url, args.jobs)
+    else:
+        bench = Bench(args)
+        try:
+            bench.run_all()
+        finally:
+            bench.close()
+        failed = [label for label, _, _, returncode in bench.results if returncode != 0]
+        if failed:
+            print(f"Failed scenarios: {', '.join(failed)}", file=sys.stderr)
+            sys.exit(1)
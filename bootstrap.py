@@ -6,35 +6,45 @@ Includes packages, languages, dotfiles, fonts, and more.
 
 > ./bootstrap.py
 
+To download everything once and bootstrap other machines without network
+access for fonts and rpms (see bundle.py):
+> ./bootstrap.py bundle dots-bundle
+> ./bootstrap.py --from-bundle dots-bundle
+
 This is the main entrypoint into this project.
 The operations are designed to be idempotent (as much as possible).
 """
 
+import argparse
 import os.path
+from typing import List
 
 from yaml import safe_load
 
-from dots import copy_dotfiles
-from fonts import (
-    get_latest_nerdfonts_release,
-    install_nerd_font,
-    update_font_cache,
-    install_fontsource_font,
-)
-from git import setup_git
-from mise import ensure_mise, mise_use
+import cache
+import tracing
+from bundle import build_bundle, open_bundle
+from dots import copy_dotfiles, dotfiles_mode
+from fonts import install_fonts
+from git import GIT_SETTINGS, setup_git
+from mise import ensure_mise, mise_use_all
 from omz import ensure_omz
+from plan import print_plan
+from prefetch import start_prefetch
 from packages import (
-    install_packages,
+    DnfTransaction,
     system_update,
-    install_groups,
     install_dnf_repo,
-    ensure_program_from_github,
     install_npm_global_packages,
-    install_go_package,
+    install_go_packages,
     install_pip_packages,
 )
-from repos import download_repo
+from repos import download_repos
+from scheduler import Stage, run_stages
+from state import State
+
+
+REPO_HOME = "./home"
 
 
 def load_bootstrap_file(file: str):
@@ -49,76 +59,248 @@ def load_bootstrap_file(file: str):
     return bootstrap_data
 
 
-def bootstrap():
-    data = load_bootstrap_file("bootstrap.yaml")
+def build_stages(data: dict, state: State, jobs: int = 4) -> List[Stage]:
+    """
+    Declare every bootstrap step as a stage along with its dependencies.
 
-    system_update()
+    Stages that run dnf (or otherwise take the rpm lock) share the "dnf"
+    lock so that they are never run at the same time. Sections tracked in
+    the state file only apply the entries that haven't been applied yet.
 
-    git_config = data["git"]
-    if git_config:
-        setup_git(git_config)
+    :param data: The loaded bootstrap.yaml
+    :param state: The record of previously applied entries
+    :param jobs: Worker limit for stages that download in parallel
+    :return: The stages to hand to the scheduler
+    """
 
-    dnf_repos = data["package_repos"]
-    for repo in dnf_repos:
-        install_dnf_repo(repo)
+    def update():
+        # There is nothing to configure here, so this only re-runs when forced
+        state.run_batch("system_update", ["dnf update"], lambda _: system_update())
 
-    groups = data["groups"]
-    if groups:
-        install_groups(groups)
+    def git_config():
+        config = data["git"]
+        if config:
+            settings = [[key, config.get(key)] for key in GIT_SETTINGS]
+            state.run_batch(
+                "git",
+                settings,
+                lambda pending: setup_git(config, keys=[key for key, _ in pending]),
+            )
 
-    packages = data["packages"]
-    if packages:
-        install_packages(packages)
+    def dnf_repos():
+        state.run_each("package_repos", data["package_repos"], install_dnf_repo)
 
-    repos = data["repos"]
-    for repo in repos:
-        download_repo(repo["target"], repo["src"])
+    # Groups, packages and github rpms are installed in a single dnf transaction
+    transaction = DnfTransaction()
 
-    ensure_omz()
+    def rpm_download():
+        for package in data["rpm_from_github"]:
+            transaction.add_rpm_from_github(
+                package["owner"], package["repo"], program_name=package.get("name")
+            )
+        # TODO: need to support the case where the package is .tar.gz rather than an rpm
+        # e.g. https://github.com/helmfile/helmfile/releases
+        transaction.download_rpms(jobs=jobs)
 
-    ensure_mise()
-    languages = data["mise"]
-    for language in languages:
-        mise_use(language)
+    def dnf_install():
+        sections = {"groups": data["groups"] or [], "packages": data["packages"] or []}
+        pending = {}
+        for section, entries in sections.items():
+            state.prune(section, entries)
+            pending[section] = state.pending(section, entries)
 
-    nerd_font_version = get_latest_nerdfonts_release() or "v3.2.1"
-    nerd_fonts = data["fonts"]["nerd"]
-    for font in nerd_fonts:
-        install_nerd_font(font, nerd_font_version)
+        transaction.add_groups(pending["groups"])
+        transaction.add_packages(pending["packages"])
+        try:
+            transaction.run()
+        except Exception:
+            for section, entries in pending.items():
+                state.record(section, entries, False)
+            raise
+        for section, entries in pending.items():
+            state.record(section, entries, True)
 
-    fontsource_fonts = data["fonts"]["fontsource"]
-    for font in fontsource_fonts:
-        install_fontsource_font(font)
+    def repos():
+        download_repos(data["repos"] or [], jobs=jobs)
 
-    update_font_cache()
+    def mise():
+        ensure_mise()
+        state.run_batch(
+            "mise",
+            data["mise"],
+            lambda pending: mise_use_all(
+                pending, jobs=jobs, force=state.is_forced("mise")
+            ),
+        )
 
-    gh_packages = data["rpm_from_github"]
-    for package in gh_packages:
-        if "name" in package:
-            name = package["name"]
-        else:
-            name = None
-        ensure_program_from_github(package["owner"], package["repo"], program_name=name)
-    # TODO: need to support the case where the package is .tar.gz rather than an rpm
-    # e.g. https://github.com/helmfile/helmfile/releases
+    def fonts():
+        # Also updates the font cache once every font is installed
+        install_fonts(data["fonts"], jobs=jobs)
+
+    def npm_global():
+        state.run_batch(
+            "npm_global",
+            data["npm_global"],
+            lambda pending: install_npm_global_packages(
+                pending, force=state.is_forced("npm_global")
+            ),
+        )
+
+    def go_install():
+        state.run_batch(
+            "go_install",
+            data["go_install"],
+            lambda pending: install_go_packages(
+                pending, jobs=jobs, force=state.is_forced("go_install")
+            ),
+        )
 
-    npm_packages = data["npm_global"]
-    if npm_packages:
-        install_npm_global_packages(npm_packages)
+    def pip_global():
+        state.run_batch(
+            "pip_global",
+            data["pip_global"],
+            lambda pending: install_pip_packages(
+                pending, user_scoped=True, force=state.is_forced("pip_global")
+            ),
+        )
 
-    go_packages = data["go_install"]
-    for package_url in go_packages:
-        install_go_package(package_url)
+    def dotfiles():
+        # Recursively go through all contents in the ./home directory and copy into ~
+        copy_dotfiles(REPO_HOME, os.path.expanduser("~"), mode=dotfiles_mode(data))
 
-    pip_packages = data["pip_global"]
-    if pip_packages:
-        install_pip_packages(pip_packages, user_scoped=True)
+    stages = [
+        Stage("system_update", update, locks=["dnf"]),
+        Stage("git_config", git_config),
+        Stage("dnf_repos", dnf_repos, needs=["system_update"], locks=["dnf"]),
+        Stage("rpm_download", rpm_download),
+        Stage(
+            "dnf_install",
+            dnf_install,
+            needs=["dnf_repos", "rpm_download"],
+            locks=["dnf"],
+        ),
+        Stage("repos", repos, needs=["dnf_install"]),
+        # omz may install zsh and change the login shell
+        Stage("omz", ensure_omz, needs=["dnf_install"], locks=["dnf"]),
+        Stage("mise", mise),
+        Stage("fonts", fonts),
+        Stage("npm_global", npm_global, needs=["mise"]),
+        Stage("go_install", go_install, needs=["mise"]),
+        Stage("pip_global", pip_global, needs=["mise"]),
+    ]
+    # Conflicts are resolved by asking, so the dotfiles run last and on their own
+    # rather than having their prompts buried in the output of other stages
+    stages.append(
+        Stage("dotfiles", dotfiles, needs=[stage.name for stage in stages])
+    )
+    return stages
 
-    # Recursively go through all contents in the ./home directory and copy into ~
-    repo_home = "./home"
-    real_home = os.path.expanduser("~")
-    copy_dotfiles(repo_home, real_home)
+
+def bootstrap(jobs: int = 4, force: List[str] = (), plan: bool = False):
+    """
+    Run every stage from bootstrap.yaml, in parallel where possible.
+
+    :param jobs: Maximum number of stages to run at the same time
+    :param force: (optional) Sections to re-apply even if nothing changed, or "all"
+    :param plan: (optional) Only print what would change, without changing anything
+    :return:
+    """
+    data = load_bootstrap_file("bootstrap.yaml")
+    state = State(force=force)
+
+    if plan:
+        print_plan(data, state, REPO_HOME, os.path.expanduser("~"), jobs=max(jobs, 8))
+        return
+
+    # Overlap downloads with the dnf update and everything else that runs first
+    prefetch = start_prefetch(data, jobs=jobs)
+    try:
+        run_stages(build_stages(data, state, jobs=jobs), jobs=jobs)
+    finally:
+        # If a stage failed (or on Ctrl-C) don't download what won't be installed,
+        # neither what is still queued nor what is in flight
+        prefetch.shutdown(wait=False, cancel_futures=True)
+        cache.cancel_downloads()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Bootstraps the full system.")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["bundle"],
+        help="bundle: download everything bootstrap.yaml needs into BUNDLE_PATH "
+        "instead of bootstrapping",
+    )
+    parser.add_argument(
+        "bundle_path",
+        nargs="?",
+        default="dots-bundle",
+        metavar="BUNDLE_PATH",
+        help="Directory, or .tar archive, to write the bundle to (default: dots-bundle)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="Maximum number of stages to run at the same time (default: 4)",
+    )
+    parser.add_argument(
+        "--force",
+        action="append",
+        default=[],
+        metavar="SECTION",
+        help="Re-apply a section (e.g. packages, mise) even if it is unchanged "
+        "since the last run. Can be repeated, or use 'all'.",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print what would change without changing anything",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Write a Chrome trace (chrome://tracing, ui.perfetto.dev) of the run to FILE",
+    )
+    cache_mode = parser.add_mutually_exclusive_group()
+    cache_mode.add_argument(
+        "--offline",
+        action="store_true",
+        help=f"Only use downloads already cached in {cache.CACHE_DIR}",
+    )
+    cache_mode.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Ignore the download cache and fetch everything again",
+    )
+    cache_mode.add_argument(
+        "--from-bundle",
+        metavar="PATH",
+        help="Serve every download from a bundle made with `bootstrap.py bundle`, "
+        "without using the network",
+    )
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
 
 
 if __name__ == "__main__":
-    bootstrap()
+    args = parse_args()
+    cache.configure(
+        offline=args.offline,
+        refresh=args.refresh,
+        bundle=open_bundle(args.from_bundle) if args.from_bundle else None,
+    )
+    try:
+        if args.command == "bundle":
+            build_bundle(load_bootstrap_file("bootstrap.yaml"), args.bundle_path, jobs=args.jobs)
+        else:
+            bootstrap(jobs=args.jobs, force=args.force, plan=args.plan)
+    finally:
+        tracing.print_summary()
+        if args.trace:
+            tracing.write_chrome_trace(args.trace)
+            print(f"Wrote trace to {args.trace}")
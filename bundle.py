@@ -0,0 +1,126 @@
+"""
+Bundles every download bootstrap.yaml implies, so more machines can be
+bootstrapped from local disk instead of the network.
+
+> ./bootstrap.py bundle dots-bundle
+> ./bootstrap.py --from-bundle dots-bundle
+
+A bundle is a directory (or a .tar of one) holding each file once under
+files/<sha256><extension> (the extension lets dnf recognise rpms), and an
+index.json mapping every url (release metadata
+included) to its file, size and checksum. Bundled files are checked against
+their checksum before they are used.
+
+Only fonts and GitHub rpms are bundled. dnf packages, git repos and
+mise/npm/go/pip tools are still fetched by those tools themselves.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+from cache import BUNDLE_FILES, BUNDLE_INDEX, blob_suffix
+from prefetch import prefetch_tasks
+
+
+def build_bundle(data: dict, path: str, jobs: int = 4):
+    """
+    Download everything bootstrap.yaml needs (even if it is installed on this
+    machine) and store it in a bundle.
+
+    :param data: The loaded bootstrap.yaml
+    :param path: Bundle directory to create or update, or a path ending in .tar to write an archive
+    :param jobs: Maximum number of downloads at the same time
+    :return:
+    """
+    tasks = prefetch_tasks(data, skip_installed=False)
+
+    def run(task):
+        try:
+            task()
+        except Exception as e:
+            return str(e)
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        failed = [error for error in pool.map(run, tasks) if error]
+    if failed:
+        raise Exception("Failed to download for the bundle:\n" + "\n".join(failed))
+
+    archive = path.endswith(".tar")
+    root = tempfile.mkdtemp(prefix="dots-bundle-") if archive else path
+    try:
+        write_bundle(root, cache.fetched())
+        if archive:
+            # The contents are already compressed, so the archive isn't
+            with tarfile.open(path, "w") as tar:
+                tar.add(root, arcname=".")
+    finally:
+        if archive:
+            shutil.rmtree(root)
+    print(f"Wrote bundle to {path}")
+
+
+def write_bundle(root: str, fetched: dict):
+    """
+    Copy downloaded files into a bundle directory and write its index.
+    Files no longer referenced by the index are removed.
+
+    :param root: The bundle directory
+    :param fetched: url -> path of the downloaded file
+    :return:
+    """
+    files_dir = os.path.join(root, BUNDLE_FILES)
+    os.makedirs(files_dir, exist_ok=True)
+
+    urls = {}
+    for url, src in sorted(fetched.items()):
+        with open(src, "rb") as f:
+            sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+        name = sha256 + blob_suffix(url)
+        dst = os.path.join(files_dir, name)
+        if not os.path.exists(dst):
+            shutil.copyfile(src, f"{dst}.tmp")
+            os.replace(f"{dst}.tmp", dst)
+        urls[url] = {
+            "file": f"{BUNDLE_FILES}/{name}",
+            "sha256": sha256,
+            "size": os.path.getsize(dst),
+        }
+
+    index_path = os.path.join(root, BUNDLE_INDEX)
+    with open(f"{index_path}.tmp", "w") as f:
+        json.dump({"urls": urls}, f, indent=2, sort_keys=True)
+    os.replace(f"{index_path}.tmp", index_path)
+
+    referenced = {os.path.basename(entry["file"]) for entry in urls.values()}
+    for name in os.listdir(files_dir):
+        if name not in referenced:
+            os.remove(os.path.join(files_dir, name))
+
+    total = sum(os.path.getsize(os.path.join(files_dir, name)) for name in referenced)
+    print(f"Bundled {len(urls)} url(s), {len(referenced)} file(s), {total / 1024 / 1024:.1f}MiB")
+
+
+def open_bundle(path: str) -> str:
+    """
+    Get a bundle ready to serve downloads from.
+
+    :param path: A bundle directory, or a .tar archive of one
+    :return: The bundle directory. Archives are extracted to a temp directory
+        that is removed when the run ends.
+    """
+    if os.path.isdir(path):
+        return path
+
+    root = tempfile.mkdtemp(prefix="dots-bundle-")
+    atexit.register(shutil.rmtree, root, ignore_errors=True)
+    with tarfile.open(path) as tar:
+        tar.extractall(root, filter="data")
+    return root
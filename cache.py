@@ -0,0 +1,545 @@
+"""
+A shared on-disk cache for everything this tool downloads.
+
+Downloads are stored under ~/.cache/dots, addressed by the sha256 of their
+content, with an index that maps each URL to its blob along with the
+ETag/Last-Modified validators from the response. Cached URLs are
+revalidated with a conditional request, so an unchanged resource costs a
+304 rather than a full download (and doesn't count against GitHub's
+unauthenticated rate limit). The least recently used entries are evicted
+once the cache grows past its size cap.
+
+Downloads can also be served from a bundle built on another machine (see
+bundle.py), in which case the network isn't used at all.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+from http.client import HTTPException
+from typing import Dict
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+from tracing import add_bytes, span
+from utils import CHUNK_SIZE
+
+CACHE_DIR = os.path.expanduser("~/.cache/dots")
+MAX_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+settings = {
+    # Never touch the network, only serve what is already cached
+    "offline": False,
+    # Ignore cached copies and download everything again
+    "refresh": False,
+    "max_size": MAX_CACHE_SIZE,
+    # Directory of a bundle to serve every download from
+    "bundle": None,
+}
+
+# Layout of a bundle directory
+BUNDLE_INDEX = "index.json"
+BUNDLE_FILES = "files"
+
+_lock = threading.RLock()
+_index: Dict[str, dict] | None = None
+# Downloads currently in progress, so concurrent fetches of a url share one request
+_inflight: Dict[str, Future] = {}
+# Urls already validated during this run, which don't need revalidating again
+_fresh = set()
+# Every url fetched during this run and the file it was served from
+_fetched: Dict[str, str] = {}
+# The index of the bundle in use: url -> {"file": ..., "sha256": ..., "size": ...}
+_bundle: Dict[str, dict] = {}
+# Bundle urls whose file was already checked against its checksum
+_verified = set()
+# Set once downloads should stop, e.g. when the process is exiting
+_cancelled = threading.Event()
+
+
+def configure(
+    offline: bool = None, refresh: bool = None, max_size: int = None, bundle: str = None
+):
+    """
+    Change how the cache behaves for the rest of the run.
+
+    :param offline: (optional) Only serve cached content, never hit the network
+    :param refresh: (optional) Ignore cached content and download it again
+    :param max_size: (optional) Size cap in bytes before entries are evicted
+    :param bundle: (optional) Serve every download from this bundle directory instead
+    :return:
+    """
+    if offline is not None:
+        settings["offline"] = offline
+    if refresh is not None:
+        settings["refresh"] = refresh
+    if max_size is not None:
+        settings["max_size"] = max_size
+    if bundle is not None:
+        with open(os.path.join(bundle, BUNDLE_INDEX), "r") as f:
+            index = json.load(f)
+        with _lock:
+            _bundle.clear()
+            _bundle.update(index["urls"])
+            _verified.clear()
+        settings["bundle"] = bundle
+
+
+def _index_path() -> str:
+    return os.path.join(CACHE_DIR, "index.json")
+
+
+def _blob_path(name: str) -> str:
+    return os.path.join(CACHE_DIR, "blobs", name)
+
+
+def _load_index() -> Dict[str, dict]:
+    global _index
+    if _index is None:
+        try:
+            with open(_index_path(), "r") as f:
+                _index = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            _index = {}
+    return _index
+
+
+def _save_index():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{_index_path()}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(_load_index(), f, indent=2)
+    os.replace(tmp_path, _index_path())
+
+
+def _cached_entry(url: str) -> dict | None:
+    """
+    Look up the index entry for a url, ignoring entries whose blob is gone.
+    """
+    with _lock:
+        entry = _load_index().get(url)
+        if entry and os.path.exists(_blob_path(entry["blob"])):
+            return entry
+        return None
+
+
+def _touch(url: str) -> str:
+    with _lock:
+        entry = _load_index()[url]
+        entry["last_used"] = time.time()
+        _save_index()
+        return _blob_path(entry["blob"])
+
+
+def blob_suffix(url: str) -> str:
+    """
+    Keep the file extension so tools like dnf recognise the cached file.
+    """
+    suffix = os.path.splitext(urlparse(url).path)[1]
+    return suffix if 0 < len(suffix) <= 8 else ""
+
+
+class VerificationError(URLError):
+    """
+    A download didn't match the size or checksum it was expected to have.
+    """
+
+
+class DownloadCancelled(Exception):
+    """
+    A download was stopped by cancel_downloads.
+    """
+
+
+def cancel_downloads():
+    """
+    Stop every download in progress after its current chunk, and refuse to
+    start new ones. Their partial files are kept, so a later run resumes them.
+    """
+    _cancelled.set()
+
+
+# How many times a dropped download is resumed before giving up
+DOWNLOAD_ATTEMPTS = 4
+# Seconds a download may stall for before it is dropped and resumed
+DOWNLOAD_TIMEOUT = 30
+# Downloads at least this big report their progress and throughput
+PROGRESS_MIN_SIZE = 4 * 1024 * 1024
+PROGRESS_INTERVAL = 2.0
+
+
+def _partial_path(url: str) -> str:
+    """
+    Where an unfinished download of a url is kept, so it can be resumed.
+    """
+    return _blob_path(f".partial-{hashlib.sha256(url.encode()).hexdigest()[:32]}")
+
+
+def _format_mib(count: int) -> str:
+    return f"{count / (1024 * 1024):.1f} MiB"
+
+
+def _stream_to_partial(url: str, headers: dict) -> tuple:
+    """
+    Download a url into its partial file, resuming with an HTTP Range request
+    if an earlier attempt left part of it behind.
+
+    :return: (partial path, sha256 hex digest, size, response headers)
+    :raises HTTPError: For error statuses, including 304 for conditional requests
+    """
+    partial = _partial_path(url)
+    validators_path = f"{partial}.json"
+
+    request_headers = dict(headers)
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+    if offset:
+        try:
+            with open(validators_path, "r") as f:
+                validators = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            validators = {}
+        request_headers["Range"] = f"bytes={offset}-"
+        # Only resume if the remote file hasn't changed since, otherwise
+        # the server answers with the full file
+        if validators.get("etag") or validators.get("last_modified"):
+            request_headers["If-Range"] = validators.get("etag") or validators["last_modified"]
+        for conditional in ("If-None-Match", "If-Modified-Since"):
+            request_headers.pop(conditional, None)
+
+    with urlopen(Request(url, headers=request_headers), timeout=DOWNLOAD_TIMEOUT) as resp:
+        if offset and resp.status != 206:
+            offset = 0
+        if offset:
+            print(f"Resuming {url} from {_format_mib(offset)}")
+        else:
+            with open(validators_path, "w") as f:
+                json.dump(
+                    {
+                        "etag": resp.headers.get("ETag"),
+                        "last_modified": resp.headers.get("Last-Modified"),
+                    },
+                    f,
+                )
+
+        digest = hashlib.sha256()
+        if offset:
+            with open(partial, "rb") as f:
+                while chunk := f.read(CHUNK_SIZE):
+                    digest.update(chunk)
+
+        remaining = resp.length
+        total = offset + remaining if remaining is not None else None
+        size = offset
+        start = last_report = time.monotonic()
+        with open(partial, "ab" if offset else "wb") as f:
+            while chunk := resp.read1(CHUNK_SIZE):
+                if _cancelled.is_set():
+                    raise DownloadCancelled(f"Download of {url} was cancelled")
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+                add_bytes("bytes_downloaded", len(chunk))
+                add_bytes("bytes_written", len(chunk))
+
+                now = time.monotonic()
+                if total and total >= PROGRESS_MIN_SIZE and now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    rate = (size - offset) / (now - start)
+                    print(
+                        f"{os.path.basename(urlparse(url).path)}: {_format_mib(size)} of "
+                        f"{_format_mib(total)} ({size * 100 // total}%) at {_format_mib(rate)}/s"
+                    )
+
+        if total is not None and size < total:
+            raise ConnectionError(f"connection closed after {size} of {total} bytes")
+
+        elapsed = time.monotonic() - start
+        if size - offset >= PROGRESS_MIN_SIZE:
+            print(
+                f"Downloaded {_format_mib(size - offset)} of {url} in {elapsed:.1f}s "
+                f"({_format_mib((size - offset) / max(elapsed, 0.001))}/s)"
+            )
+        return partial, digest.hexdigest(), size, resp.headers
+
+
+def _download(
+    url: str, headers: dict, expected_size: int = None, expected_sha256: str = None
+) -> str:
+    """
+    Download a url into the blob store and record it in the index.
+
+    Dropped connections are retried, resuming from where they stopped. The
+    result is checked against the expected size and checksum before it is
+    added to the cache.
+
+    :return: Path to the blob
+    :raises HTTPError: For error statuses, including 304 for conditional requests
+    :raises VerificationError: If the download doesn't match what was expected
+    :raises DownloadCancelled: If cancel_downloads was called
+    """
+    os.makedirs(os.path.join(CACHE_DIR, "blobs"), exist_ok=True)
+
+    attempt = 1
+    while True:
+        if _cancelled.is_set():
+            raise DownloadCancelled(f"Download of {url} was cancelled")
+        try:
+            partial, sha256, size, resp_headers = _stream_to_partial(url, headers)
+            break
+        except HTTPError as e:
+            if e.code == 416:
+                # The partial file doesn't fit the remote file, start over
+                os.remove(_partial_path(url))
+                continue
+            raise
+        except (URLError, OSError, HTTPException) as e:
+            if attempt >= DOWNLOAD_ATTEMPTS:
+                raise URLError(f"Failed to download {url} after {attempt} attempts: {e}")
+            print(f"Download of {url} was interrupted ({e}), retrying.")
+            attempt += 1
+            _cancelled.wait(attempt)
+
+    os.remove(f"{partial}.json")
+    problem = None
+    if expected_size is not None and size != expected_size:
+        problem = f"expected {expected_size} bytes but got {size}"
+    elif expected_sha256 and sha256 != expected_sha256.lower():
+        problem = f"expected sha256 {expected_sha256} but got {sha256}"
+    if problem:
+        os.remove(partial)
+        raise VerificationError(f"Downloaded {url} doesn't match its metadata: {problem}")
+
+    blob = sha256 + blob_suffix(url)
+    os.replace(partial, _blob_path(blob))
+
+    with _lock:
+        previous = _load_index().get(url)
+        _load_index()[url] = {
+            "blob": blob,
+            "size": size,
+            "etag": resp_headers.get("ETag"),
+            "last_modified": resp_headers.get("Last-Modified"),
+            "last_used": time.time(),
+        }
+        if previous and previous["blob"] != blob:
+            _remove_unreferenced(previous["blob"])
+        evict(keep=url)
+        _save_index()
+
+    return _blob_path(blob)
+
+
+def _matches(entry: dict, expected_size: int = None, expected_sha256: str = None) -> bool:
+    """
+    Check a cached entry against the expected size and checksum.
+    """
+    if expected_size is not None and entry["size"] != expected_size:
+        return False
+    if expected_sha256 and not entry["blob"].startswith(expected_sha256.lower()):
+        return False
+    return True
+
+
+def fetch(
+    url: str,
+    headers: dict = None,
+    immutable: bool = False,
+    expected_size: int = None,
+    expected_sha256: str = None,
+) -> str:
+    """
+    Get the content at a url, from the cache where possible.
+
+    Cached entries are revalidated with If-None-Match/If-Modified-Since,
+    once per run. If the network is unavailable a cached copy is used as a
+    fallback. If the url is already being downloaded (e.g. by a prefetch)
+    this waits for that download rather than starting another one, and
+    tries again itself if that download fails.
+
+    :param url: The url to download
+    :param headers: (optional) Extra request headers
+    :param immutable: (optional) The url never changes content (e.g. a
+        versioned release asset), so a cached copy is used without revalidating.
+    :param expected_size: (optional) Reject the download unless it has this many bytes
+    :param expected_sha256: (optional) Reject the download unless it has this checksum
+    :return: Path to the downloaded file. Treat it as read-only.
+    :raises URLError: If the url couldn't be downloaded and isn't cached
+    :raises DownloadCancelled: If cancel_downloads was called
+    """
+    retried = False
+    while True:
+        with _lock:
+            future = _inflight.get(url)
+            owner = future is None
+            if owner:
+                future = _inflight[url] = Future()
+        if owner:
+            break
+
+        try:
+            return future.result()
+        except Exception:
+            # e.g. a background prefetch that failed. Try once more before
+            # giving up, rather than inheriting its error.
+            if retried:
+                raise
+            retried = True
+
+    try:
+        with span(url, "http") as current:
+            if settings["bundle"]:
+                path = _from_bundle(url, expected_size, expected_sha256)
+                current.args["status"] = "bundle"
+            else:
+                path, current.args["status"] = _fetch(
+                    url, headers, immutable, expected_size, expected_sha256
+                )
+        with _lock:
+            _fetched[url] = path
+        future.set_result(path)
+        return path
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _lock:
+            del _inflight[url]
+
+
+def _fetch(
+    url: str, headers: dict, immutable: bool, expected_size: int, expected_sha256: str
+):
+    """
+    :return: (path, how the request was served)
+    """
+    if settings["refresh"] and url not in _fresh:
+        entry = None
+    else:
+        entry = _cached_entry(url)
+    if entry and not _matches(entry, expected_size, expected_sha256):
+        entry = None
+
+    if settings["offline"]:
+        if not entry:
+            raise URLError(f"{url} is not cached and running in offline mode")
+        return _touch(url), "cached"
+
+    if entry and (immutable or url in _fresh):
+        return _touch(url), "cached"
+
+    request_headers = dict(headers or {})
+    if entry:
+        if entry["etag"]:
+            request_headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            request_headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        path = _download(url, request_headers, expected_size, expected_sha256)
+        _fresh.add(url)
+        return path, 200
+    except VerificationError:
+        raise
+    except URLError as e:
+        # Including error statuses, e.g. GitHub's 403 once the rate limit is hit
+        if entry and isinstance(e, HTTPError) and e.code == 304:
+            _fresh.add(url)
+            return _touch(url), 304
+        if entry:
+            print(f"Failed to revalidate {url}, using cached copy: {e}")
+            return _touch(url), "stale"
+        raise
+
+
+def _from_bundle(url: str, expected_size: int, expected_sha256: str) -> str:
+    """
+    :return: Path to the bundled file
+    :raises URLError: If the url isn't in the bundle
+    :raises VerificationError: If the file doesn't match the bundle index or what was expected
+    """
+    entry = _bundle.get(url)
+    if not entry:
+        raise URLError(f"{url} is not in the bundle {settings['bundle']}")
+    if (expected_size is not None and entry["size"] != expected_size) or (
+        expected_sha256 and entry["sha256"] != expected_sha256.lower()
+    ):
+        raise VerificationError(f"The bundled copy of {url} isn't the expected file")
+
+    path = os.path.join(settings["bundle"], entry["file"])
+    with _lock:
+        verified = url in _verified
+    if not verified:
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        if digest != entry["sha256"]:
+            raise VerificationError(f"{path} doesn't match its checksum in the bundle index")
+        with _lock:
+            _verified.add(url)
+    return path
+
+
+def fetched() -> Dict[str, str]:
+    """
+    :return: Every url fetched so far during this run, and the file it was served from
+    """
+    with _lock:
+        return dict(_fetched)
+
+
+def fetch_json(url: str, headers: dict = None):
+    """
+    Fetch a url through the cache and parse it as json.
+
+    :param url: The url to download
+    :param headers: (optional) Extra request headers
+    :return: The parsed json
+    """
+    with open(fetch(url, headers=headers), "rb") as f:
+        return json.load(f)
+
+
+def evict(keep: str = None):
+    """
+    Drop the least recently used entries until the cache fits in its size cap.
+
+    Several urls can point at the same blob, so a blob is only removed once
+    nothing in the index refers to it anymore. Urls fetched during this run
+    are never dropped, their files may still be about to be used.
+
+    :param keep: (optional) Another url that must stay cached, e.g. the one just downloaded
+    :return:
+    """
+    with _lock:
+        index = _load_index()
+        entries = sorted(index.items(), key=lambda item: item[1]["last_used"])
+
+        blob_sizes = {entry["blob"]: entry["size"] for _, entry in entries}
+        total = sum(blob_sizes.values())
+
+        for url, entry in entries:
+            if total <= settings["max_size"]:
+                break
+            if url == keep or url in _fetched:
+                continue
+            del index[url]
+            if _remove_unreferenced(entry["blob"]):
+                total -= entry["size"]
+
+
+def _remove_unreferenced(blob: str) -> bool:
+    """
+    Delete a blob if no url in the index points at it anymore.
+
+    :return: Whether the blob was removed
+    """
+    if any(entry["blob"] == blob for entry in _load_index().values()):
+        return False
+    try:
+        os.remove(_blob_path(blob))
+    except FileNotFoundError:
+        pass
+    return True
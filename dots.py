@@ -10,13 +10,59 @@ and copy it to the $HOME directory of the current user.
 
 It will avoid overwriting newer content, optionally giving you the
 ability to copy the newer file into this repo.
+
+Every deployed file is recorded in a manifest along with its stat details,
+so unchanged files are skipped on later runs without being read.
+
+Files are written next to their target and renamed into place, so an
+interrupted run never leaves a half written file behind. A journal lets the
+next run finish (or undo) a batch that was interrupted.
+> ./dots.py --verify
+ignores the manifest and compares every file by content.
+
+> ./dots.py --watch
+keeps running and syncs files as they change (see watch.py).
+
+> ./dots.py --target /home/alice --target /home/bob --policy overwrite
+deploys to several home directories at once (see targets.py).
+
+> ./dots.py --mode reflink
+deploys files as copy-on-write clones where the filesystem supports it
+(e.g. btrfs). The other modes are copy (the default), hardlink and symlink.
 """
 
+import argparse
+import ctypes
 import difflib
-import filecmp
+import errno
+import fcntl
+import hashlib
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from shutil import copy2
+from shutil import copy2, copyfileobj, copystat
+from typing import Tuple
+
+# Relative to the user's home directory
+MANIFEST_PATH = ".local/state/dots/manifest.json"
+JOURNAL_PATH = ".local/state/dots/journal.json"
+# Files are written to ".<name>.dots-tmp" next to the target before being renamed over it
+TEMP_SUFFIX = ".dots-tmp"
+
+# How files are put in place in the home directory
+DEPLOY_MODES = ("copy", "reflink", "hardlink", "symlink")
+# From <linux/fs.h>, clones a whole file on copy-on-write filesystems
+FICLONE = 0x40049409
+
+# Files are compared and hashed in blocks of this size
+CHUNK_SIZE = 1024 * 1024
+# Only this much of each file is read to show a diff
+DIFF_MAX_BYTES = 1024 * 1024
+# Diffs are cut off after this many lines
+DIFF_MAX_LINES = 200
+# A NUL byte within this many bytes of the start marks a file as binary
+BINARY_SNIFF_BYTES = 8192
 
 
 def get_last_modified(file_path: str) -> datetime:
@@ -29,90 +75,793 @@ def get_last_modified(file_path: str) -> datetime:
     return datetime.fromtimestamp(os.path.getmtime(file_path))
 
 
-def show_diff(file1: str, file2: str):
+def is_binary(file_path: str) -> bool:
+    """
+    Guess whether a file is binary the same way git does, by looking for a
+    NUL byte near the start.
+
+    :param file_path: Path to the file to examine
+    :return:
+    """
+    with open(file_path, "rb") as f:
+        return b"\0" in f.read(BINARY_SNIFF_BYTES)
+
+
+def read_lines(file_path: str, max_bytes: int) -> Tuple[list, bool]:
+    """
+    Read the lines of a text file, stopping after max_bytes characters.
+    Anything that isn't valid utf-8 is replaced rather than raising.
+
+    :param file_path: Path to the file to read
+    :param max_bytes: How much of the file to read at most
+    :return: (lines, whether the file was cut short)
+    """
+    lines = []
+    total = 0
+    with open(file_path, "r", errors="replace") as f:
+        while total < max_bytes:
+            # Limit the read so one huge line (e.g. minified json) can't blow the cap
+            line = f.readline(max_bytes - total)
+            if not line:
+                return lines, False
+            lines.append(line)
+            total += len(line)
+        return lines, bool(f.read(1))
+
+
+def describe(file_path: str) -> str:
+    return f"{file_path}: {os.path.getsize(file_path)} bytes, sha256 {file_hash(file_path)}"
+
+
+def show_diff(
+    file1: str,
+    file2: str,
+    max_bytes: int = DIFF_MAX_BYTES,
+    max_lines: int = DIFF_MAX_LINES,
+):
     """
     Show the diff between two files
 
+    Binary files are summarised by their size and hash instead. Text diffs
+    only look at the first max_bytes of each file and are printed as they
+    are produced, up to max_lines lines.
+
     :param file1: Base file
     :param file2: Possibly changed file to compare
+    :param max_bytes: (optional) How much of each file to read
+    :param max_lines: (optional) Maximum number of diff lines to print
     :return:
     """
-    with open(file1, "r") as f1, open(file2, "r") as f2:
-        diff = difflib.unified_diff(
-            f1.readlines(),
-            f2.readlines(),
-            fromfile=file1,
-            tofile=file2,
-        )
-        for line in diff:
-            print(line, end="")
+    if is_binary(file1) or is_binary(file2):
+        print("Binary files differ")
+        print(f"  {describe(file1)}")
+        print(f"  {describe(file2)}")
+        return
+
+    lines1, truncated1 = read_lines(file1, max_bytes)
+    lines2, truncated2 = read_lines(file2, max_bytes)
+    diff = difflib.unified_diff(lines1, lines2, fromfile=file1, tofile=file2)
+
+    for count, line in enumerate(diff):
+        if count == max_lines:
+            print(f"... diff cut off after {max_lines} lines")
+            break
+        print(line, end="" if line.endswith("\n") else "\n")
+
+    if truncated1 or truncated2:
+        print(f"... only the first {max_bytes} bytes of each file were compared")
 
 
 def identical(file1: str, file2: str) -> bool:
     """
     Compare two files and return a boolean for whether they are identical.
 
+    Files of different sizes are never read, and otherwise reading stops at
+    the first block that differs.
+
     :param file1:
     :param file2:
     :return:
     """
-    return filecmp.cmp(file1, file2, shallow=False)
+    if os.path.getsize(file1) != os.path.getsize(file2):
+        return False
 
+    with open(file1, "rb") as f1, open(file2, "rb") as f2:
+        while True:
+            chunk1 = f1.read(CHUNK_SIZE)
+            if chunk1 != f2.read(CHUNK_SIZE):
+                return False
+            if not chunk1:
+                return True
 
-def copy_dotfiles(repo_home: str, user_home: str):
+
+def file_hash(file_path: str) -> str:
     """
-    Go through all files in the dot files root and copy into the user's home directory
+    Hash the contents of a file without reading it all into memory.
 
-    :param repo_home: The root path to the dot files to copy over
+    :param file_path: Path to the file to hash
+    :return: sha256 hex digest
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stat_key(file_path: str) -> list:
+    """
+    The stat details used to tell whether a file changed since it was synced.
+
+    :param file_path: Path to the file to examine
+    :return: [size, mtime_ns, inode]
+    """
+    st = os.stat(file_path)
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def load_manifest(user_home: str) -> dict:
+    """
+    Load the record of previously synced files.
+
+    :param user_home: The user's home directory
+    :return: relative path -> {"src": stat_key, "dst": stat_key, "sha256": hash}
+    """
+    try:
+        with open(os.path.join(user_home, MANIFEST_PATH), "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(user_home: str, manifest: dict):
+    """
+    Persist the record of synced files.
+
+    :param user_home: The user's home directory
+    :param manifest: The manifest to save
+    :return:
+    """
+    write_json(os.path.join(user_home, MANIFEST_PATH), manifest)
+
+
+def write_json(path: str, data, durable: bool = False):
+    """
+    Replace a json file atomically.
+
+    :param path: The file to write
+    :param data: What to write to it
+    :param durable: (optional) Make sure the new content survives a crash
+        before returning
+    :return:
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(f"{path}.tmp", path)
+    if durable:
+        fsync_dirs([os.path.dirname(path)])
+
+
+def fsync_dirs(dirs):
+    """
+    Make the renames and new files in the given directories durable.
+    """
+    for path in set(dirs):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def sync_filesystems(paths):
+    """
+    Flush everything written to the filesystems holding the given paths,
+    with one syncfs() per filesystem. Unlike os.sync() this doesn't wait on
+    other filesystems (or on what dnf and friends are writing elsewhere).
+    Falls back to os.sync() where syncfs() isn't available.
+
+    :param paths: Existing files or directories
+    :return:
+    """
+    by_device = {os.stat(path).st_dev: path for path in paths}
+    try:
+        syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except AttributeError:
+        os.sync()
+        return
+
+    for path in by_device.values():
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if syncfs(fd) != 0:
+                raise OSError(ctypes.get_errno(), f"syncfs failed for {path}")
+        finally:
+            os.close(fd)
+
+
+def synced_entry(
+    repo_file: str, real_file: str, mode: str = "copy", sha256: str = None
+) -> dict:
+    """
+    The manifest entry recording that two files are in sync as of now.
+    Pass sha256 if the repo file was already hashed to avoid reading it again.
+    """
+    return {
+        "src": stat_key(repo_file),
+        "dst": stat_key(real_file),
+        "sha256": sha256 or file_hash(repo_file),
+        "mode": mode,
+    }
+
+
+def linked_mode(repo_file: str, real_file: str) -> str | None:
+    """
+    Check whether the deployed file is a link to the one in the repo.
+
+    :param repo_file: The file in the dotfiles repo
+    :param real_file: The deployed file in the user's home directory
+    :return: "symlink", "hardlink", or None for an independent file
+    """
+    if os.path.islink(real_file):
+        if os.path.realpath(real_file) == os.path.realpath(repo_file):
+            return "symlink"
+        return None
+    if os.path.samefile(repo_file, real_file):
+        return "hardlink"
+    return None
+
+
+def reflink(src: str, dst: str):
+    """
+    Copy a file as a copy-on-write clone, so no data is copied until one of
+    them changes. Where the filesystem can't clone, copy_file_range at least
+    keeps the copy in the kernel, and failing that it is copied normally.
+
+    :param src: File to copy
+    :param dst: Where to put the copy
+    :return:
+    """
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            try:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            except OSError:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                copyfileobj(fsrc, fdst, CHUNK_SIZE)
+    copystat(src, dst)
+
+
+def temp_path(file_path: str) -> str:
+    """
+    Where a file is written before it is renamed into place. It has to be in
+    the same directory so the rename is atomic.
+    """
+    head, tail = os.path.split(file_path)
+    return os.path.join(head, f".{tail}{TEMP_SUFFIX}")
+
+
+def stage_file(src: str, dst: str, mode: str = "copy") -> str:
+    """
+    Write a file next to where it should end up, without touching the target.
+
+    :param src: The file to deploy
+    :param dst: Where it should end up
+    :param mode: One of DEPLOY_MODES. Hard links that can't be made (e.g.
+        across filesystems) fall back to a copy.
+    :return: The temp file to rename over dst
+    """
+    temp = temp_path(dst)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    # Left over from an interrupted run. Removing it also makes sure we never
+    # write through a link.
+    if os.path.lexists(temp):
+        os.unlink(temp)
+
+    if mode == "symlink":
+        os.symlink(os.path.abspath(src), temp)
+    elif mode == "hardlink":
+        try:
+            os.link(src, temp)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            print(f"Can't hard link {dst} ({e.strerror}). Copying instead.")
+            copy2(src, temp)
+    elif mode == "reflink":
+        reflink(src, temp)
+    else:
+        copy2(src, temp)
+    return temp
+
+
+def deploy_file(src: str, dst: str, mode: str = "copy"):
+    """
+    Put a single file in place atomically. Links left by an earlier deploy
+    are replaced rather than written through.
+
+    :param src: The file to deploy
+    :param dst: Where it should end up
+    :param mode: One of DEPLOY_MODES
+    :return:
+    """
+    os.replace(stage_file(src, dst, mode), dst)
+
+
+def deploy_files(repo_home: str, user_home: str, rel_paths: list, mode: str, jobs: int):
+    """
+    Deploy a batch of files so that an interruption never leaves a file half
+    written, and the batch can be finished or undone on the next run.
+
+    Every file is written to a temp file next to its target. Once all of them
+    are written, one syncfs() per filesystem makes them durable instead of an
+    fsync per file. The journal is then durably marked as committed, so from
+    here on recovery finishes the batch rather than undoing it. Finally the
+    temp files are renamed over their targets, and the renames are made
+    durable before the journal is removed.
+
+    :param repo_home: The root path to the dot files
     :param user_home: The user's home directory
+    :param rel_paths: The files to deploy, relative to both roots
+    :param mode: One of DEPLOY_MODES
+    :param jobs: Number of files to write at the same time
     :return:
     """
+    if not rel_paths:
+        return
+
+    real_files = [os.path.join(user_home, rel_path) for rel_path in rel_paths]
+    real_dirs = {os.path.dirname(real_file) for real_file in real_files}
+    journal = os.path.join(user_home, JOURNAL_PATH)
+    write_json(journal, {"state": "staging", "files": real_files})
+
+    def stage(rel_path: str):
+        stage_file(os.path.join(repo_home, rel_path), os.path.join(user_home, rel_path), mode)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            list(pool.map(stage, rel_paths))
+        sync_filesystems(real_dirs | {os.path.dirname(journal)})
+    except BaseException:
+        recover_journal(user_home)
+        raise
+
+    write_json(journal, {"state": "commit", "files": real_files}, durable=True)
+    for rel_path, real_file in zip(rel_paths, real_files):
+        os.replace(temp_path(real_file), real_file)
+        print(f"Deployed {os.path.join(repo_home, rel_path)} to {real_file} ({mode})")
+    fsync_dirs(real_dirs)
+    os.remove(journal)
+
+
+def recover_journal(user_home: str):
+    """
+    Deal with a batch of deploys that was interrupted. If all of its files
+    were written the renames are finished, otherwise the temp files are
+    removed and the targets are left as they were.
+
+    :param user_home: The user's home directory
+    :return:
+    """
+    journal = os.path.join(user_home, JOURNAL_PATH)
+    try:
+        with open(journal, "r") as f:
+            pending = json.load(f)
+    except FileNotFoundError:
+        return
+    except json.JSONDecodeError:
+        # Only the rename makes the journal visible, so this isn't ours
+        print(f"Ignoring unreadable journal {journal}")
+        os.remove(journal)
+        return
+
+    commit = pending["state"] == "commit"
+    for real_file in pending["files"]:
+        temp = temp_path(real_file)
+        if not os.path.lexists(temp):
+            continue
+        if commit:
+            os.replace(temp, real_file)
+            print(f"Finished deploying {real_file} from an interrupted run")
+        else:
+            os.unlink(temp)
+    if commit:
+        fsync_dirs(
+            os.path.dirname(real_file)
+            for real_file in pending["files"]
+            if os.path.isdir(os.path.dirname(real_file))
+        )
+    else:
+        print("Removed the temp files of an interrupted run")
+    os.remove(journal)
+
+
+# Outcomes of comparing a file in ./home with the one in $HOME
+IDENTICAL = "identical"
+COPY = "copy"
+CONFLICT = "conflict"
+
+
+def unchanged_since_sync(
+    repo_file: str, real_file: str, entry: dict | None, mode: str = "copy"
+) -> bool:
+    """
+    Check the manifest to see whether neither side changed since the last
+    sync, which was done with the same deploy mode.
+
+    This only looks at stat details, so neither file is read.
+
+    :param repo_file: The file in the dotfiles repo
+    :param real_file: The deployed file in the user's home directory
+    :param entry: The manifest entry from the last sync, if any
+    :param mode: The deploy mode in use now
+    :return:
+    """
+    return (
+        entry is not None
+        and entry.get("mode", "copy") == mode
+        and os.path.exists(real_file)
+        and entry["src"] == stat_key(repo_file)
+        and entry["dst"] == stat_key(real_file)
+    )
+
+
+def classify(
+    repo_file: str,
+    real_file: str,
+    verify: bool = False,
+    mode: str = "copy",
+    repo_sha256: str = None,
+) -> str:
+    """
+    Work out what needs to happen to bring a file in $HOME up to date.
+
+    A link to the repo file only counts as identical when that kind of link
+    is the mode in use, and a separate file with the same contents only when
+    copying. Redeploying matching contents in another mode is never a conflict.
+
+    :param repo_file: The file in the dotfiles repo
+    :param real_file: The deployed file in the user's home directory
+    :param verify: (optional) Compare by hash rather than byte by byte
+    :param mode: (optional) The deploy mode in use
+    :param repo_sha256: (optional) The hash of the repo file, if it is already
+        known. Only the deployed file is read then.
+    :return: IDENTICAL, COPY, or CONFLICT when the deployed file is newer
+    """
+    if not os.path.exists(real_file):
+        return COPY
+
+    linked = linked_mode(repo_file, real_file)
+    if linked:
+        return IDENTICAL if linked == mode else COPY
+
+    if repo_sha256:
+        same = (
+            os.path.getsize(repo_file) == os.path.getsize(real_file)
+            and file_hash(real_file) == repo_sha256
+        )
+    elif verify:
+        same = file_hash(repo_file) == file_hash(real_file)
+    else:
+        same = identical(repo_file, real_file)
+
+    if same:
+        return IDENTICAL if mode in ("copy", "reflink") else COPY
+
+    if get_last_modified(real_file) > get_last_modified(repo_file):
+        return CONFLICT
+    return COPY
+
+
+def check_file(
+    repo_file: str, real_file: str, entry: dict | None, verify: bool, mode: str = "copy"
+):
+    """
+    Compare a single file without changing anything.
+
+    :param repo_file: The file in the dotfiles repo
+    :param real_file: The deployed file in the user's home directory
+    :param entry: The manifest entry from the last sync, if any
+    :param verify: Ignore the manifest and compare by content
+    :param mode: (optional) One of DEPLOY_MODES
+    :return: (outcome, new manifest entry for identical files or None to keep the current one)
+    """
+    if not verify and unchanged_since_sync(repo_file, real_file, entry, mode):
+        return IDENTICAL, None
+
+    outcome = classify(repo_file, real_file, verify, mode)
+
+    if outcome == IDENTICAL:
+        print(f"Files {repo_file} and {real_file} are identical. Skipping.")
+        return outcome, synced_entry(repo_file, real_file, mode)
+    return outcome, None
+
+
+def sync_file(
+    repo_file: str, real_file: str, entry: dict | None, verify: bool, mode: str = "copy"
+):
+    """
+    Compare a single file and deploy it unless the deployed file is newer.
+
+    :param repo_file: The file in the dotfiles repo
+    :param real_file: The deployed file in the user's home directory
+    :param entry: The manifest entry from the last sync, if any
+    :param verify: Ignore the manifest and compare by content
+    :param mode: (optional) One of DEPLOY_MODES
+    :return: (outcome, new manifest entry or None to keep the current one)
+    """
+    outcome, new_entry = check_file(repo_file, real_file, entry, verify, mode)
+
+    if outcome == COPY:
+        deploy_file(repo_file, real_file, mode)
+        print(f"Deployed {repo_file} to {real_file} ({mode})")
+        new_entry = synced_entry(repo_file, real_file, mode)
+    return outcome, new_entry
+
+
+def dotfiles_mode(data: dict) -> str:
+    """
+    The deploy mode set in the `dotfiles:` section of bootstrap.yaml.
+
+    :param data: The parsed bootstrap.yaml
+    :return: One of DEPLOY_MODES, "copy" if it isn't set
+    """
+    mode = (data.get("dotfiles") or {}).get("mode", "copy")
+    assert mode in DEPLOY_MODES, f"dotfiles mode must be one of {DEPLOY_MODES}"
+    return mode
+
+
+def list_dotfiles(repo_home: str) -> list:
+    """
+    Find every file in the dot files root.
+
+    :param repo_home: The root path to the dot files
+    :return: Paths relative to repo_home
+    """
+    rel_paths = []
     for root, dirs, files in os.walk(repo_home):
         for file in files:
-            repo_file = os.path.join(root, file)
-            real_file = os.path.join(
-                user_home,
-                os.path.relpath(repo_file, repo_home),
+            rel_paths.append(os.path.relpath(os.path.join(root, file), repo_home))
+    return rel_paths
+
+
+def copy_dotfiles(
+    repo_home: str,
+    user_home: str,
+    verify: bool = False,
+    jobs: int = 8,
+    mode: str = "copy",
+    diff_max_bytes: int = DIFF_MAX_BYTES,
+    diff_max_lines: int = DIFF_MAX_LINES,
+):
+    """
+    Go through all files in the dot files root and copy into the user's home directory
+
+    This happens in two phases. First every file is compared across a pool
+    of threads and the changed ones are deployed as one batch (see
+    deploy_files). Files that are newer in the home directory are held back
+    as conflicts, which are then resolved interactively once all the other
+    work is done.
+
+    :param repo_home: The root path to the dot files to copy over
+    :param user_home: The user's home directory
+    :param verify: (optional) Ignore the manifest and compare every file by content
+    :param jobs: (optional) Number of files to compare and copy at the same time
+    :param mode: (optional) How to deploy files, one of DEPLOY_MODES
+    :param diff_max_bytes: (optional) How much of each conflicting file to diff
+    :param diff_max_lines: (optional) Maximum number of lines to show of each conflict's diff
+    :return:
+    """
+    assert mode in DEPLOY_MODES, f"Unknown deploy mode '{mode}'"
+    recover_journal(user_home)
+    manifest = load_manifest(user_home)
+    rel_paths = list_dotfiles(repo_home)
+
+    def check(rel_path: str):
+        return check_file(
+            os.path.join(repo_home, rel_path),
+            os.path.join(user_home, rel_path),
+            manifest.get(rel_path),
+            verify,
+            mode,
+        )
+
+    def deployed_entry(rel_path: str) -> dict:
+        return synced_entry(
+            os.path.join(repo_home, rel_path), os.path.join(user_home, rel_path), mode
+        )
+
+    copies = []
+    conflicts = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            for rel_path, (outcome, entry) in zip(rel_paths, pool.map(check, rel_paths)):
+                if entry:
+                    manifest[rel_path] = entry
+                if outcome == COPY:
+                    copies.append(rel_path)
+                elif outcome == CONFLICT:
+                    conflicts.append(rel_path)
+
+            deploy_files(repo_home, user_home, copies, mode, jobs)
+            for rel_path, entry in zip(copies, pool.map(deployed_entry, copies)):
+                manifest[rel_path] = entry
+
+        resolve_conflicts(
+            repo_home,
+            user_home,
+            sorted(conflicts),
+            manifest,
+            mode,
+            diff_max_bytes,
+            diff_max_lines,
+        )
+    finally:
+        save_manifest(user_home, manifest)
+
+
+def resolve_conflicts(
+    repo_home: str,
+    user_home: str,
+    conflicts: list,
+    manifest: dict,
+    mode: str = "copy",
+    diff_max_bytes: int = DIFF_MAX_BYTES,
+    diff_max_lines: int = DIFF_MAX_LINES,
+):
+    """
+    Ask what to do with each file that is newer in the home directory.
+
+    Answering with an upper case letter applies that choice to all the
+    remaining conflicts.
+
+    :param repo_home: The root path to the dot files
+    :param user_home: The user's home directory
+    :param conflicts: Relative paths of the conflicting files
+    :param manifest: The sync manifest to update
+    :param mode: (optional) How to deploy the files that are resolved
+    :param diff_max_bytes: (optional) How much of each file to diff
+    :param diff_max_lines: (optional) Maximum number of lines to show of each diff
+    :return:
+    """
+    if conflicts:
+        print(f"\n{len(conflicts)} file(s) are newer in {user_home} than in {repo_home}")
+
+    apply_to_all = None
+    for rel_path in conflicts:
+        repo_file = os.path.join(repo_home, rel_path)
+        real_file = os.path.join(user_home, rel_path)
+
+        if apply_to_all:
+            choice = apply_to_all
+        else:
+            print(f"\nFile {real_file} is newer than {repo_file}")
+            show_diff(repo_file, real_file, diff_max_bytes, diff_max_lines)
+
+            choice = input(
+                "What would you like to do? [o]verwrite, [c]opy to source, [s]kip, [q]uit "
+                "(O/C/S for all remaining): "
             )
+            if choice in ("O", "C", "S"):
+                apply_to_all = choice.lower()
+            choice = choice.lower()
 
-            if os.path.exists(real_file):
-                if identical(repo_file, real_file):
-                    print(f"Files {repo_file} and {real_file} are identical. Skipping.")
-                    continue
-
-                repo_time = get_last_modified(repo_file)
-                real_time = get_last_modified(real_file)
-
-                if real_time > repo_time:
-                    print(f"\nFile {real_file} is newer than {repo_file}")
-                    show_diff(repo_file, real_file)
-
-                    choice = input(
-                        "What would you like to do? [o]verwrite, [c]opy to source, [s]kip, [q]uit: "
-                    ).lower()
-
-                    if choice == "o":
-                        copy2(repo_file, real_file)
-                        print(f"Overwrote {real_file}")
-                    elif choice == "c":
-                        copy2(real_file, repo_file)
-                        print(f"Copied {real_file} to {repo_file}")
-                    elif choice == "s":
-                        print("Skipped")
-                    elif choice == "q":
-                        return
-                    else:
-                        print("Invalid choice, skipping")
-                else:
-                    copy2(repo_file, real_file)
-                    print(f"Copied {repo_file} to {real_file}")
-            else:
-                os.makedirs(os.path.dirname(real_file), exist_ok=True)
-                copy2(repo_file, real_file)
-                print(f"Copied {repo_file} to {real_file}")
+        if choice == "o":
+            deploy_file(repo_file, real_file, mode)
+            manifest[rel_path] = synced_entry(repo_file, real_file, mode)
+            print(f"Overwrote {real_file}")
+        elif choice == "c":
+            deploy_file(real_file, repo_file)
+            if mode != "copy":
+                deploy_file(repo_file, real_file, mode)
+            manifest[rel_path] = synced_entry(repo_file, real_file, mode)
+            print(f"Copied {real_file} to {repo_file}")
+        elif choice == "s":
+            print(f"Skipped {real_file}")
+        elif choice == "q":
+            return
+        else:
+            print("Invalid choice, skipping")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync ./home into $HOME.")
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Compare every file by content instead of trusting the sync manifest",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=8,
+        help="Number of files to compare and copy at the same time (default: 8)",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=DEPLOY_MODES,
+        default="copy",
+        help="How to deploy files: copy them, clone them with reflinks where "
+        "the filesystem supports it, or hard/symbolic link them (default: copy)",
+    )
+    parser.add_argument(
+        "--diff-lines",
+        type=int,
+        default=DIFF_MAX_LINES,
+        help=f"Maximum lines of diff to show per conflict (default: {DIFF_MAX_LINES})",
+    )
+    parser.add_argument(
+        "--diff-bytes",
+        type=int,
+        default=DIFF_MAX_BYTES,
+        help=f"How much of each conflicting file to diff (default: {DIFF_MAX_BYTES})",
+    )
+    parser.add_argument(
+        "--target",
+        action="append",
+        default=[],
+        metavar="DIR",
+        help="Deploy to this home directory instead of $HOME. Can be repeated "
+        "to deploy to several at once without asking about conflicts",
+    )
+    parser.add_argument(
+        "--policy",
+        choices=("newer", "overwrite", "report"),
+        default="newer",
+        help="With --target, what to do with files that are newer in a target: "
+        "keep them, overwrite them or only report them (default: newer)",
+    )
+    parser.add_argument(
+        "--report",
+        metavar="FILE",
+        help="With --target, also write the report for each target to a json file",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and sync files in ./home as soon as they change",
+    )
+    args = parser.parse_args()
+
     dotfiles = "./home"
     home = os.path.expanduser("~")
-    copy_dotfiles(dotfiles, home)
+    if args.target:
+        from targets import deploy_targets, print_reports
+
+        reports = deploy_targets(
+            dotfiles, args.target, mode=args.mode, policy=args.policy, jobs=args.jobs
+        )
+        print_reports(reports)
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(reports, f, indent=2)
+        if any(report["error"] or report["conflicts"] for report in reports):
+            raise SystemExit(1)
+    elif args.watch:
+        from watch import watch
+
+        watch(dotfiles, home, mode=args.mode)
+    else:
+        copy_dotfiles(
+            dotfiles,
+            home,
+            verify=args.verify,
+            jobs=args.jobs,
+            mode=args.mode,
+            diff_max_bytes=args.diff_bytes,
+            diff_max_lines=args.diff_lines,
+        )
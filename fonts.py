@@ -1,13 +1,28 @@
 import json
 import os.path
-from io import BytesIO
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 from urllib.error import URLError
-from urllib.request import urlopen, Request
 from zipfile import ZipFile
 
-from utils import cmd
+from cache import fetch, fetch_json
+from tracing import add_bytes, propagate, span
+from utils import CHUNK_SIZE, cmd
 
 FONTS_DIR = os.path.expanduser("~/.local/share/fonts/")
+DEFAULT_NERD_FONT_VERSION = "v3.2.1"
+
+GITHUB_API = "https://api.github.com"
+NERD_FONTS_DOWNLOAD = "https://github.com/ryanoasis/nerd-fonts/releases/download"
+FONTSOURCE_API = "https://api.fontsource.org/v1"
+FONTSOURCE_CDN = "https://r2.fontsource.org"
+
+# Even though it their API is unauthenticated, I think their CDN is blocking
+# requests without headers.
+FONTSOURCE_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
 
 
 def get_latest_nerdfonts_release() -> str | None:
@@ -16,10 +31,9 @@ def get_latest_nerdfonts_release() -> str | None:
 
     :return: latest release | None
     """
-    url = "https://api.github.com/repos/ryanoasis/nerd-fonts/releases/latest"
+    url = f"{GITHUB_API}/repos/ryanoasis/nerd-fonts/releases/latest"
     try:
-        with urlopen(url) as resp:
-            data = json.loads(resp.read().decode())
+        data = fetch_json(url)
         return data["tag_name"]
     except (URLError, json.JSONDecodeError, KeyError) as e:
         print(f"Failed to fetch latest release: {e}")
@@ -39,97 +53,171 @@ def font_exists(font: str) -> bool:
     )
 
 
-def install_nerd_font(font: str, version: str):
+def nerd_font_url(font: str, version: str) -> str:
+    """
+    :param font: Font name, matching the zip name in the release
+    :param version: The nerd fonts release tag
+    :return: The download URL for the font's zip
+    """
+    return f"{NERD_FONTS_DOWNLOAD}/{version}/{font}.zip"
+
+
+def install_nerd_font(font: str, version: str) -> Tuple[bool, str | None]:
+    """
+    Download a font from the nerd fonts release if it doesn't already exist on your machine.
+
+    :param font: Font name, matching the zip name in the release
+    :param version: The nerd fonts release tag
+    :return: (whether the font is available after this call, the directory
+        it was installed into or None if nothing changed)
+    """
     font_dir = os.path.join(FONTS_DIR, font)
 
     if font_exists(font):
         print(f"{font} already exists on system. Skipping.")
-        return
+        return True, None
 
-    base_url = f"https://github.com/ryanoasis/nerd-fonts/releases/download/{version}/"
-    font_url = f"{base_url}{font}.zip"
+    font_url = nerd_font_url(font, version)
 
     print(f"Downloading {font}@{version} from nerd fonts.")
 
     try:
-        with urlopen(font_url) as resp:
-            font_data = resp.read()
+        # The url is pinned to a release, so a cached copy never goes stale
+        archive = fetch(font_url, immutable=True)
     except URLError as e:
         print(f"Failed to download {font}: {e}")
-        return
+        return False, None
 
-    with ZipFile(BytesIO(font_data)) as zip_file:
+    with ZipFile(archive) as zip_file:
         os.makedirs(font_dir, exist_ok=True)
 
-        for file in zip_file.namelist():
-            zip_file.extract(file, font_dir)
+        # extract() streams each member to disk rather than reading it whole
+        for member in zip_file.infolist():
+            zip_file.extract(member, font_dir)
+            add_bytes("bytes_written", member.file_size)
 
     print(f"{font} installed into {font_dir}")
+    return True, font_dir
 
 
-def update_font_cache():
+def update_font_cache(dirs: List[str]):
     """
-    Use the local fc-cache tool to generate the font cache files.
+    Use the local fc-cache tool to update the font cache files of the given
+    directories, rather than rescanning every font directory on the system.
+
+    Their parent directories are passed too, because the parent's cache lists
+    the font directories inside it. fc-cache skips any directory whose cache
+    is still up to date.
 
     Run this after downloading new fonts.
+    :param dirs: The font directories that changed
     :return:
     """
-    cmd(["fc-cache"])
+    if not dirs:
+        print("No fonts changed. Skipping fc-cache.")
+        return
 
+    dirs = set(dirs)
+    cmd(["fc-cache"] + sorted(dirs | {os.path.dirname(d) for d in dirs}))
 
-def install_fontsource_font(font: str):
+
+def get_fontsource_download_url(font: str) -> str:
+    """
+    Look up a font family on fontsource and build the URL of its zip.
+
+    :param font: Font name
+    :return: The download URL
+    :raises URLError, json.JSONDecodeError, KeyError, IndexError: If the font can't be found
+    """
+    font_details_url = f"{FONTSOURCE_API}/fonts?family={font.replace(' ', '%20')}"
+    data = fetch_json(font_details_url, headers=FONTSOURCE_HEADERS)
+    font_id = data[0]["id"]
+    return f"{FONTSOURCE_CDN}/fonts/{font_id}@latest/download.zip"
+
+
+def install_fontsource_font(font: str) -> Tuple[bool, str | None]:
     """
     Download a font from fontsource.org if it doesn't already exist on your machine.
     :param font: Font name
-    :return:
+    :return: (whether the font is available after this call, the directory
+        it was installed into or None if nothing changed)
     """
     formatted_font = font.replace(" ", "")
     font_dir = os.path.join(FONTS_DIR, formatted_font)
 
     if font_exists(formatted_font):
         print(f"{font} already exists on system. Skipping.")
-        return
+        return True, None
 
-    font_details_url = (
-        f"https://api.fontsource.org/v1/fonts?family={font.replace(' ', '%20')}"
-    )
-    # Even though it their API is unauthenticated, I think their CDN is blocking
-    # requests without headers.
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
-
-    req = Request(font_details_url, headers=headers)
     try:
-        with urlopen(req) as resp:
-            data = json.loads(resp.read().decode())
-        font_id = data[0]["id"]
+        download_url = get_fontsource_download_url(font)
     except (URLError, json.JSONDecodeError, KeyError, IndexError) as e:
         print(f"Failed to find font {font} from fontsource. \n{e}")
-        return
-
-    download_url = f"https://r2.fontsource.org/fonts/{font_id}@latest/download.zip"
-
-    req = Request(download_url, headers=headers)
+        return False, None
 
     try:
-        with urlopen(req) as resp:
-            font_data = resp.read()
+        archive = fetch(download_url, headers=FONTSOURCE_HEADERS)
     except URLError as e:
         print(f"Failed to download {font}: {e}")
-        return
+        return False, None
 
-    with ZipFile(BytesIO(font_data)) as zip_file:
+    with ZipFile(archive) as zip_file:
         os.makedirs(font_dir, exist_ok=True)
 
         for file in zip_file.namelist():
             if file.startswith("ttf/") and "latin" in file:
-                content = zip_file.read(file)
                 filename = os.path.basename(file)
 
-                with open(os.path.join(font_dir, filename), "wb") as f:
-                    f.write(content)
+                with zip_file.open(file) as src, open(
+                    os.path.join(font_dir, filename), "wb"
+                ) as f:
+                    shutil.copyfileobj(src, f, CHUNK_SIZE)
+                add_bytes("bytes_written", zip_file.getinfo(file).file_size)
             elif file == "LICENSE":
                 zip_file.extract(file, font_dir)
+                add_bytes("bytes_written", zip_file.getinfo(file).file_size)
 
     print(f"{font} installed into {font_dir}")
+    return True, font_dir
+
+
+def install_fonts(fonts: dict, jobs: int = 4) -> List[str]:
+    """
+    Install every font from the `fonts:` section of bootstrap.yaml.
+
+    Downloads run in a pool of `jobs` workers. A font that fails to install
+    is reported but doesn't stop the others. The font cache is only
+    updated once, after every font has been processed, and only for the
+    directories of fonts that were actually installed.
+
+    :param fonts: The `fonts:` section, with optional `nerd` and `fontsource` lists
+    :param jobs: Maximum number of fonts to download at the same time
+    :return: The fonts that failed to install
+    """
+    nerd_fonts = fonts.get("nerd") or []
+    fontsource_fonts = fonts.get("fontsource") or []
+
+    tasks = []
+    if nerd_fonts:
+        version = get_latest_nerdfonts_release() or DEFAULT_NERD_FONT_VERSION
+        tasks += [(font, install_nerd_font, (font, version)) for font in nerd_fonts]
+    tasks += [(font, install_fontsource_font, (font,)) for font in fontsource_fonts]
+
+    def install(task) -> Tuple[bool, str | None]:
+        font, func, args = task
+        try:
+            with span(font, "font"):
+                return func(*args)
+        except Exception as e:
+            print(f"Failed to install {font}: {e}")
+            return False, None
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        results = list(pool.map(propagate(install), tasks))
+
+    failed = [font for (font, _, _), (ok, _) in zip(tasks, results) if not ok]
+    if failed:
+        print(f"Failed to install fonts: {', '.join(failed)}")
+
+    update_font_cache([font_dir for _, font_dir in results if font_dir])
+    return failed
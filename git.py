@@ -1,28 +1,29 @@
-import subprocess
+from utils import cmd
 
+# bootstrap.yaml key -> global git config key
+GIT_SETTINGS = {
+    "name": "user.name",
+    "email": "user.email",
+    "defaultBranch": "init.defaultBranch",
+    "autoRemote": "push.autoSetupRemote",
+}
 
-def setup_git(config):
+
+def setup_git(config, keys=None):
+    """
+    Set the global git config from the `git:` section of bootstrap.yaml.
+
+    :param config: The `git:` section
+    :param keys: (optional) Only set these keys of the section. Defaults to all of them.
+    :return:
+    """
     assert config["name"], "Missing git.name definition"
     assert config["email"], "Missing git.email definition"
     assert config["defaultBranch"], "Missing git.defaultBranch definition"
     assert config["autoRemote"], "Missing git.autoRemote definition"
 
-    commands = [
-        ["git", "config", "--global", "user.name", config["name"]],
-        ["git", "config", "--global", "user.email", config["email"]],
-        ["git", "config", "--global", "init.defaultBranch", config["defaultBranch"]],
-        ["git", "config", "--global", "push.autoSetupRemote", config["autoRemote"]],
-    ]
-
-    for cmd in commands:
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
+    for key in keys or GIT_SETTINGS:
+        cmd(
+            ["git", "config", "--global", GIT_SETTINGS[key], config[key]],
+            "Error running git operation",
         )
-
-        if result.returncode != 0:
-            print(result.stderr)
-            raise Exception(
-                f"Received return code {result.returncode} when running git operation"
-            )
@@ -1,6 +1,11 @@
+import json
 import os
-import subprocess
 from shutil import which
+from typing import List, Tuple
+
+from utils import cmd, run
+
+MISE_BIN = os.path.expanduser("~/.local/bin/mise")
 
 
 def ensure_mise():
@@ -29,37 +34,87 @@ def install_mise():
     Installs the mise tool using their installer script.
     :return:
     """
-    result = subprocess.run(
-        [
-            "/bin/bash",
-            "-c",
-            "curl https://mise.run | sh",
-        ],
-        capture_output=True,
-        text=True,
+    cmd(
+        ["/bin/bash", "-c", "curl https://mise.run | sh"],
+        "Error attempting to install mise",
     )
+
+
+def split_tool(tool: str) -> Tuple[str, str | None]:
+    """
+    Split "node@20" or "npm:@scope/pkg@1" into the tool name and requested version.
+
+    :param tool:
+    :return:
+    """
+    at = tool.rfind("@")
+    if at > 0 and tool[at - 1] != ":":
+        return tool[:at], tool[at + 1 :]
+    return tool, None
+
+
+def installed_tools() -> dict:
+    """
+    Ask mise once which tools of the global config are installed.
+
+    :return: A dict of tool name to the list of installed versions. Empty if mise can't be queried.
+    """
+    try:
+        result = run([MISE_BIN, "ls", "--global", "--json"], capture=True, echo=False)
+    except FileNotFoundError:
+        return {}
     if result.returncode != 0:
-        print(result.stderr)
-        raise Exception(
-            f"Received return code {result.returncode} when attempting to install mise"
-        )
+        return {}
+    try:
+        tools = json.loads(result.stdout or "{}")
+    except json.JSONDecodeError:
+        return {}
+    return {
+        name: [v["version"] for v in versions if v.get("installed", True)]
+        for name, versions in tools.items()
+    }
 
 
-def mise_use(lang: str):
-    result = subprocess.run(
-        [
-            os.path.expanduser("~/.local/bin/mise"),
-            "use",
-            "--global",
-            lang,
-            "-y",
-        ],
-        capture_output=True,
-        text=True,
+def missing_tools(tools: List[str]) -> List[str]:
+    """
+    Find which tools aren't installed at the requested version yet. A version
+    like "20" is matched as a prefix the same way mise does, so 20.11.1
+    satisfies it. No version or "latest" accepts any installed version.
+
+    :param tools: e.g. ["go", "node@20"]
+    :return: The tools that still need installing
+    """
+    installed = installed_tools()
+    missing = []
+    for tool in tools:
+        name, version = split_tool(tool)
+        versions = installed.get(name, [])
+        if not version or version == "latest":
+            satisfied = bool(versions)
+        else:
+            satisfied = any(v == version or v.startswith(f"{version}.") for v in versions)
+        if not satisfied:
+            missing.append(tool)
+    return missing
+
+
+def mise_use_all(tools: List[str], jobs: int = 4, force=False):
+    """
+    Install every tool that is missing with a single `mise use`, letting mise
+    download and install them in parallel. Its progress is streamed as it goes.
+
+    :param tools: e.g. ["go", "node@20"]
+    :param jobs: Number of tools mise installs at the same time
+    :param force: (optional) Install everything without checking what is already installed
+    :return:
+    """
+    if not force:
+        tools = missing_tools(tools)
+    if not tools:
+        print("All mise tools are already installed. Skipping.")
+        return
+
+    cmd(
+        [MISE_BIN, "use", "--global", "--yes", "--jobs", str(max(1, jobs))] + tools,
+        f"Error attempting to install {tools} with mise",
     )
-    if result.returncode != 0:
-        print(result.stderr)
-        raise Exception(
-            f"Received return code {result.returncode} when attempting to install mise"
-        )
-    print(result.stdout)
@@ -1,8 +1,8 @@
 import os
-import subprocess
 from shutil import which
 
 from packages import install_packages
+from utils import cmd
 
 
 def get_user() -> str:
@@ -21,18 +21,14 @@ def get_login_shell(user: str) -> str:
     :param user: Target linux user
     :return: The login shell
     """
-    result = subprocess.run(
+    stdout = cmd(
         ["grep", user, "/etc/passwd"],
-        capture_output=True,
-        text=True,
+        "Error attempting to get login shell",
+        capture=True,
+        echo=False,
     )
-    if result.returncode != 0:
-        print(result.stderr)
-        raise Exception(
-            f"Received return code {result.returncode} when attempting to get login shell"
-        )
 
-    line = result.stdout.strip()
+    line = stdout.strip()
     return line.split(":")[-1]
 
 
@@ -44,16 +40,10 @@ def change_login_shell(user: str, shell: str):
     :param shell: Path to the target shell (e.g. /usr/bin/zsh)
     :return:
     """
-    result = subprocess.run(
+    cmd(
         ["sudo", "chsh", "--shell", shell, user],
-        capture_output=True,
-        text=True,
+        f"Error attempting to set login shell '{shell}' for user '{user}'",
     )
-    if result.returncode != 0:
-        print(result.stderr)
-        raise Exception(
-            f"Received return code {result.returncode} when attempting to set login shell '{shell}' for user '{user}'"
-        )
 
 
 def ensure_omz():
@@ -77,17 +67,11 @@ def ensure_omz():
     if exists:
         return
 
-    result = subprocess.run(
+    cmd(
         [
             "/bin/bash",
             "-c",
             "curl -fsSL https://raw.githubusercontent.com/ohmyzsh/ohmyzsh/master/tools/install.sh | sh -s -- --unattended --keep-zshrc",
         ],
-        capture_output=True,
-        text=True,
+        "Error attempting to install omz",
     )
-    if result.returncode != 0:
-        print(result.stderr)
-        raise Exception(
-            f"Received return code {result.returncode} when attempting to install omz"
-        )
@@ -1,14 +1,19 @@
 import json
-import subprocess
+import os
+import re
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from shutil import which
-from typing import List
+from typing import List, Tuple
 from urllib.error import URLError
-from urllib.request import urlopen
 
-from utils import cmd
+from cache import fetch, fetch_json
+from tracing import propagate
+from utils import cmd, run
 import platform
 
+GITHUB_API = "https://api.github.com"
+
 
 def system_update():
     """
@@ -16,63 +21,83 @@ def system_update():
 
     :return:
     """
+    cmd(["sudo", "dnf", "update", "-y"], "Error performing system update")
 
-    result = subprocess.run(
-        ["sudo", "dnf", "update", "-y"],
-        capture_output=True,
-        text=True,
-    )
-    print(result.stdout)
 
-    if result.returncode != 0:
-        print(result.stderr)
-        raise Exception(
-            f"Received return code {result.returncode} when performing system update"
-        )
+def missing_packages(packages: List[str]) -> List[str]:
+    """
+    Find which packages aren't installed yet with a single rpm database query.
 
+    Local `.rpm` files are always treated as missing.
 
-def install_groups(groups: List[str]):
+    :param packages: Package names (or capabilities they provide)
+    :return: The packages that still need installing
     """
-    Perform a `dnf group install` against the target group(s)
+    names = [package for package in packages if not package.endswith(".rpm")]
+    if not names:
+        return list(packages)
 
-    :param groups: The dnf groups to install
-    :return:
+    try:
+        result = run(["rpm", "-q", "--whatprovides"] + names, capture=True, echo=False)
+    except FileNotFoundError:
+        return list(packages)
+
+    # rpm reports each capability that nothing installed provides
+    not_provided = set(re.findall(r"^no package provides (.+)$", result.stdout, re.M))
+    return [
+        package
+        for package in packages
+        if package.endswith(".rpm") or package in not_provided
+    ]
+
+
+def missing_groups(groups: List[str]) -> List[str]:
     """
+    Find which dnf groups aren't installed yet.
 
-    result = subprocess.run(
-        ["sudo", "dnf", "group", "install", "-y"] + groups,
-        capture_output=True,
-        text=True,
-    )
-    print(result.stdout)
+    Groups aren't tracked in the rpm database, so this asks dnf using only its
+    local cache, which avoids loading any repo metadata.
 
-    if result.returncode != 0:
-        print(result.stderr)
-        raise Exception(
-            f"Received return code {result.returncode} when installing {groups}"
+    :param groups: The group names
+    :return: The groups that still need installing
+    """
+    try:
+        result = run(
+            ["dnf", "group", "list", "--installed", "--cacheonly"],
+            capture=True,
+            echo=False,
         )
+    except FileNotFoundError:
+        return list(groups)
+    if result.returncode != 0:
+        return list(groups)
+
+    # dnf4 lists one name per line, dnf5 prints a table with an id, name and
+    # installed column. Either way match whole cells rather than substrings.
+    installed = set()
+    for line in result.stdout.splitlines():
+        for cell in re.split(r"\s{2,}", line.strip()):
+            installed.add(re.sub(r"\s+\(.*\)$", "", cell).lower())
+
+    return [group for group in groups if group.lower() not in installed]
 
 
 def install_packages(packages: List[str]):
     """
     Perform a `dnf install` against the target package(s)
 
+    Packages that are already installed are left out, and dnf isn't run at
+    all when every package is installed.
+
     :param packages: The dnf packages to install
     :return:
     """
+    packages = missing_packages(packages)
+    if not packages:
+        print("All packages are already installed. Skipping.")
+        return
 
-    result = subprocess.run(
-        ["sudo", "dnf", "install", "-y"] + packages,
-        capture_output=True,
-        text=True,
-    )
-    print(result.stdout)
-
-    if result.returncode != 0:
-        print(result.stderr)
-        raise Exception(
-            f"Received return code {result.returncode} when installing {packages}"
-        )
+    cmd(["sudo", "dnf", "install", "-y"] + packages, f"Error installing {packages}")
 
 
 def install_dnf_repo(repo: dict):
@@ -114,11 +139,10 @@ def install_dnf_repo(repo: dict):
 
 
 def get_latest_release_github(org: str, repo: str):
-    url = f"https://api.github.com/repos/{org}/{repo}/releases/latest"
+    url = f"{GITHUB_API}/repos/{org}/{repo}/releases/latest"
 
     try:
-        with urlopen(url) as resp:
-            data = json.loads(resp.read())
+        data = fetch_json(url)
     except URLError as e:
         print(f"Failed to get latest release for {org}/{repo}: {e}")
         return
@@ -136,48 +160,56 @@ def get_release_assets(data) -> List[dict]:
     return data["assets"]
 
 
-def get_rpm_asset_url(assets: List[dict], arch: str) -> str | None:
+def get_rpm_asset(assets: List[dict], arch: str) -> dict | None:
     """
-    Grab the URL for the rpm file from the asset based on the system architecture.
+    Grab the rpm file from the assets based on the system architecture.
     :param assets:
     :param arch: system architecture
-    :return: The download URL
+    :return: The release asset
     """
     noarch = None
     for asset in assets:
         if asset["name"].endswith(f"{arch}.rpm"):
-            return asset["browser_download_url"]
+            return asset
         elif asset["name"].endswith(f"{platform.machine().lower()}.rpm"):
             # TODO: Make this not suck
             # I'm not happy with this. But I'm lazy atm.
             # Perhaps I should take in a list/tuple of arch and loop over them
-            return asset["browser_download_url"]
+            return asset
         elif asset["name"].endswith(f"noarch.rpm"):
-            noarch = asset["browser_download_url"]
+            noarch = asset
 
     # fallback to a noarch option if there isn't a match and it is available
     return noarch
 
 
-def install_rpm_from_url(url: str):
+def get_asset_sha256(asset: dict) -> str | None:
     """
-    Download a `.rpm` file from a URL and install it.
+    GitHub publishes a digest such as "sha256:abc..." for each release asset.
 
-    :param url:
-    :return:
+    :param asset: A release asset
+    :return: The sha256 hex digest, or None if the asset doesn't have one
     """
-    try:
-        with urlopen(url) as resp:
-            data = resp.read()
-            with tempfile.NamedTemporaryFile(mode="wb", suffix=".rpm") as f:
-                f.write(data)
-                f.flush()
+    algorithm, _, digest = (asset.get("digest") or "").partition(":")
+    return digest if algorithm == "sha256" and digest else None
 
-                install_packages([f.name])
-    except URLError as e:
-        print(f"Failed to download {url}: {e}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
+
+def download_rpm_asset(asset: dict) -> str:
+    """
+    Download a release asset, checking it against the size and checksum
+    from the release metadata.
+
+    :param asset: A release asset
+    :return: Path to the downloaded rpm
+    :raises URLError: If the download fails or doesn't match its metadata
+    """
+    # Release assets are versioned, so a cached copy never goes stale
+    return fetch(
+        asset["browser_download_url"],
+        immutable=True,
+        expected_size=asset.get("size"),
+        expected_sha256=get_asset_sha256(asset),
+    )
 
 
 def is_program_installed(program: str) -> bool:
@@ -208,53 +240,407 @@ def get_system_architecture():
         return arch
 
 
-def ensure_program_from_github(owner: str, repo: str, program_name=None):
+def get_github_rpm(owner: str, repo: str, program_name=None) -> dict | None:
     """
-    Makes sure that a program from a github repo is installed.
+    Find the rpm to download for a program from a github repo.
 
     :param owner:
     :param repo:
     :param program_name: (optional) If the repo name doesn't match the program name then define program_name
-    :return:
+    :return: The release asset, or None if the program is already installed
     """
     # If the program_name is defined, use that. Otherwise default to repo.
     program = program_name or repo
     if is_program_installed(program):
-        return
+        return None
+
+    return resolve_github_rpm(owner, repo)
 
+
+def resolve_github_rpm(owner: str, repo: str) -> dict | None:
+    """
+    Find the rpm matching this system in the latest release of a github repo.
+
+    :param owner:
+    :param repo:
+    :return: The release asset, or None if the release has no matching rpm
+    """
     arch = get_system_architecture()
     release = get_latest_release_github(owner, repo)
     assets = get_release_assets(release)
-    url = get_rpm_asset_url(assets, arch)
-    install_rpm_from_url(url)
-    print(f"{repo} installed.")
+    return get_rpm_asset(assets, arch)
+
 
+class DnfTransaction:
+    """
+    Collects groups, packages and rpm files so they can all be installed
+    with a single `dnf install`. That way metadata loading, dependency
+    resolution and the rpmdb lock only happen once.
+    """
 
-def install_npm_global_packages(packages: List[str]):
+    def __init__(self):
+        self.groups: List[str] = []
+        self.packages: List[str] = []
+        self.github_rpms: List[tuple] = []
+        self.rpm_paths: List[str] = []
+
+    def add_groups(self, groups: List[str]):
+        self.groups += groups
+
+    def add_packages(self, packages: List[str]):
+        self.packages += packages
+
+    def add_rpm_from_github(self, owner: str, repo: str, program_name=None):
+        self.github_rpms.append((owner, repo, program_name))
+
+    def download_rpms(self, jobs: int = 4):
+        """
+        Resolve and download the rpm for every github program concurrently.
+        Programs that are already installed are skipped, and failures are
+        reported and left out of the transaction.
+
+        :param jobs: Maximum number of downloads at the same time
+        :return:
+        """
+
+        def download(github_rpm: tuple) -> str | None:
+            owner, repo, program_name = github_rpm
+            try:
+                asset = get_github_rpm(owner, repo, program_name=program_name)
+                if not asset:
+                    return None
+                return download_rpm_asset(asset)
+            except Exception as e:
+                print(f"Failed to download the rpm for {owner}/{repo}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            paths = pool.map(propagate(download), self.github_rpms)
+            self.rpm_paths += [path for path in paths if path]
+        self.github_rpms = []
+
+    def specs(self) -> List[str]:
+        """
+        The arguments to pass to `dnf install`, leaving out anything already installed.
+
+        :return:
+        """
+        groups = [f"@{group}" for group in missing_groups(self.groups)] if self.groups else []
+        return groups + missing_packages(self.packages + self.rpm_paths)
+
+    def run(self):
+        """
+        Install everything that was added in one dnf transaction.
+
+        :return:
+        """
+        if self.github_rpms:
+            self.download_rpms()
+
+        specs = self.specs()
+        if not specs:
+            print("Everything is already installed. Skipping dnf.")
+            return
+
+        cmd(["sudo", "dnf", "install", "-y"] + specs, f"Error installing {specs}")
+
+
+def version_tuple(version: str) -> tuple:
     """
-    Bulk install global npm packages
-    :param packages:
+    Turn a version string such as "v1.22.0" or "5.4.0-beta" into a tuple that
+    can be compared. Only the numeric parts are used.
+
+    :param version:
     :return:
     """
-    cmd(["npm", "install", "-g"] + packages, f"Error installing {packages}")
+    return tuple(int(part) for part in re.findall(r"\d+", version))
+
+
+def is_outdated(installed: str | None, wanted: str | None) -> bool:
+    """
+    Whether an installed version needs replacing.
+
+    :param installed: The installed version, or None if it isn't installed
+    :param wanted: The configured version. None or "latest" accepts any installed version.
+    :return:
+    """
+    if installed is None:
+        return True
+    if not wanted or wanted == "latest":
+        return False
+    return version_tuple(installed) < version_tuple(wanted)
 
 
-def install_go_package(url: str):
+def split_npm_spec(spec: str) -> Tuple[str, str | None]:
     """
-    go install a url
+    Split "typescript@5.4.0" or "@astrojs/language-server@2" into name and version.
+
+    :param spec:
+    :return:
+    """
+    at = spec.rfind("@")
+    if at > 0:
+        return spec[:at], spec[at + 1 :]
+    return spec, None
+
+
+def normalize_pip_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def split_pip_spec(spec: str) -> Tuple[str, str | None]:
+    """
+    Split "pyright==1.1.360" or "ansible>=9" into a normalized name and the
+    minimum version. Other specifiers are treated as having no version.
+
+    :param spec:
+    :return:
+    """
+    match = re.match(r"\s*([A-Za-z0-9][A-Za-z0-9._-]*)(?:\[[^]]*\])?\s*(?:(==|>=|~=)\s*([^\s,;]+))?", spec)
+    if not match:
+        return normalize_pip_name(spec), None
+    return normalize_pip_name(match.group(1)), match.group(3)
+
+
+def split_go_spec(url: str) -> Tuple[str, str | None]:
+    """
+    Split "golang.org/x/tools/gopls@latest" into package path and version.
+
     :param url:
     :return:
     """
-    cmd(["go", "install", url])
+    path, _, version = url.partition("@")
+    return path, version or None
+
+
+def go_binary_name(path: str) -> str:
+    """
+    The name `go install` gives the binary built from a package path. A major
+    version suffix such as ".../cmd/foo/v2" is skipped.
+
+    :param path:
+    :return:
+    """
+    parts = path.rstrip("/").split("/")
+    if len(parts) > 1 and re.fullmatch(r"v\d+", parts[-1]):
+        return parts[-2]
+    return parts[-1]
+
+
+def installed_npm_packages() -> dict:
+    """
+    Read the global npm tree once.
+
+    :return: A dict of package name to installed version. Empty if npm can't be queried.
+    """
+    try:
+        result = run(["npm", "ls", "-g", "--depth=0", "--json"], capture=True, echo=False)
+    except FileNotFoundError:
+        return {}
+    # npm exits non-zero for problems such as unmet peer dependencies but
+    # still prints the tree
+    try:
+        tree = json.loads(result.stdout or "{}")
+    except json.JSONDecodeError:
+        return {}
+    return {
+        name: info.get("version", "")
+        for name, info in tree.get("dependencies", {}).items()
+    }
 
 
-def install_pip_packages(packages: List[str], user_scoped=False):
+def installed_pip_packages(user_scoped=False) -> dict:
     """
-    Batch install pip packages
-    :param packages:
+    Read the installed pip packages once.
+
+    :param user_scoped: (optional) Only look at the user site
+    :return: A dict of normalized package name to installed version. Empty if pip can't be queried.
+    """
+    args = ["pip", "list", "--format=json"] + (["--user"] if user_scoped else [])
+    try:
+        result = run(args, capture=True, echo=False)
+    except FileNotFoundError:
+        return {}
+    if result.returncode != 0:
+        return {}
+    try:
+        packages = json.loads(result.stdout or "[]")
+    except json.JSONDecodeError:
+        return {}
+    return {normalize_pip_name(p["name"]): p["version"] for p in packages}
+
+
+def go_bin_dir() -> str | None:
+    """
+    Where `go install` puts binaries: GOBIN, or the bin directory of the first GOPATH entry.
+
+    :return:
+    """
+    try:
+        result = run(["go", "env", "GOBIN", "GOPATH"], capture=True, echo=False)
+    except FileNotFoundError:
+        return None
+    if result.returncode != 0:
+        return None
+    gobin, gopath = (result.stdout.splitlines() + ["", ""])[:2]
+    if gobin:
+        return gobin
+    if gopath:
+        return os.path.join(gopath.split(os.pathsep)[0], "bin")
+    return None
+
+
+def installed_go_binaries() -> dict:
+    """
+    Read the build info embedded in every binary in the go bin directory with a
+    single `go version -m` call.
+
+    :return: A dict of package path to the version of the module it was built from
+    """
+    bin_dir = go_bin_dir()
+    if not bin_dir or not os.path.isdir(bin_dir):
+        return {}
+    binaries = [
+        entry.path for entry in os.scandir(bin_dir) if entry.is_file()
+    ]
+    if not binaries:
+        return {}
+
+    try:
+        result = run(["go", "version", "-m"] + binaries, capture=True, echo=False)
+    except FileNotFoundError:
+        return {}
+
+    # Each binary is a "<file>: go1.x" line followed by tab indented
+    # "path <pkg>" and "mod <module> <version> <sum>" lines
+    installed = {}
+    path = None
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        if not line.startswith("\t"):
+            path = None
+        elif fields[0] == "path" and len(fields) > 1:
+            path = fields[1]
+        elif fields[0] == "mod" and path and len(fields) > 2:
+            installed[path] = fields[2]
+    return installed
+
+
+def missing_npm_packages(packages: List[str]) -> List[str]:
+    """
+    Find the global npm packages that are missing or older than their configured version.
+
+    :param packages: Names, optionally with a version e.g. "typescript@5.4.0"
+    :return: The packages that still need installing
+    """
+    installed = installed_npm_packages()
+    return [
+        spec
+        for spec in packages
+        if is_outdated(installed.get(split_npm_spec(spec)[0]), split_npm_spec(spec)[1])
+    ]
+
+
+def missing_go_packages(urls: List[str]) -> List[str]:
+    """
+    Find the go packages whose binary is missing or was built from an older
+    version than the configured one. "@latest" accepts whatever is installed.
+
+    :param urls: e.g. ["golang.org/x/tools/gopls@latest"]
+    :return: The urls that still need installing
+    """
+    installed = installed_go_binaries()
+    return [
+        url
+        for url in urls
+        if is_outdated(installed.get(split_go_spec(url)[0]), split_go_spec(url)[1])
+    ]
+
+
+def missing_pip_packages(packages: List[str], user_scoped=False) -> List[str]:
+    """
+    Find the pip packages that are missing or older than their configured version.
+
+    :param packages: Requirement specs, e.g. "ruff-lsp" or "pyright==1.1.360"
+    :param user_scoped: (optional) Only look at the user site
+    :return: The packages that still need installing
+    """
+    installed = installed_pip_packages(user_scoped)
+    return [
+        spec
+        for spec in packages
+        if is_outdated(installed.get(split_pip_spec(spec)[0]), split_pip_spec(spec)[1])
+    ]
+
+
+def install_npm_global_packages(packages: List[str], force=False):
+    """
+    Bulk install the global npm packages that are missing or older than
+    their configured version.
+
+    :param packages: Names, optionally with a version e.g. "typescript@5.4.0"
+    :param force: (optional) Install everything without checking what is already installed
+    :return:
+    """
+    if not force:
+        packages = missing_npm_packages(packages)
+    if not packages:
+        print("All npm packages are already installed. Skipping.")
+        return
+    cmd(["npm", "install", "-g"] + packages, f"Error installing {packages}")
+
+
+def install_go_packages(urls: List[str], jobs: int = 4, force=False):
+    """
+    go install the urls whose binary is missing or was built from an older
+    version than the configured one. "@latest" accepts whatever is installed.
+
+    The builds run in parallel. They share the default module and build
+    caches, which go locks itself, so common dependencies are only
+    downloaded and compiled once.
+
+    :param urls: e.g. ["golang.org/x/tools/gopls@latest"]
+    :param jobs: Maximum number of builds to run at the same time
+    :param force: (optional) Install everything without checking what is already installed
+    :return:
+    """
+    if not force:
+        urls = missing_go_packages(urls)
+    if not urls:
+        print("All go packages are already installed. Skipping.")
+        return
+
+    def build(url: str) -> str | None:
+        try:
+            cmd(["go", "install", url], f"Error installing {url}")
+        except Exception as e:
+            print(e)
+            return url
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        failed = [url for url in pool.map(build, urls) if url]
+
+    if failed:
+        raise Exception(f"Failed to install go packages: {', '.join(failed)}")
+
+
+def install_pip_packages(packages: List[str], user_scoped=False, force=False):
+    """
+    Batch install the pip packages that are missing or older than their
+    configured version.
+
+    :param packages: Requirement specs, e.g. "ruff-lsp" or "pyright==1.1.360"
     :param user_scoped: (optional) bool whether to use --user flag
+    :param force: (optional) Install everything without checking what is already installed
     :return:
     """
+    if not force:
+        packages = missing_pip_packages(packages, user_scoped)
+    if not packages:
+        print("All pip packages are already installed. Skipping.")
+        return
+
     if user_scoped:
         cmd(["pip", "install", "--user"] + packages)
     else:
@@ -0,0 +1,224 @@
+"""
+Works out what bootstrap would change without changing anything.
+
+> ./bootstrap.py --plan
+
+Every check is read-only and they all run concurrently, so the plan for a
+full bootstrap.yaml comes back quickly.
+"""
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from dots import (
+    CONFLICT,
+    COPY,
+    classify,
+    dotfiles_mode,
+    list_dotfiles,
+    load_manifest,
+    unchanged_since_sync,
+)
+from fonts import font_exists
+from git import GIT_SETTINGS
+from mise import missing_tools
+from packages import (
+    is_program_installed,
+    missing_go_packages,
+    missing_groups,
+    missing_npm_packages,
+    missing_packages,
+    missing_pip_packages,
+)
+from repos import not_updatable, upstream_moved
+from state import State
+from utils import run
+
+
+def plan_git(config: dict) -> List[str]:
+    """
+    Compare the wanted git config against the current global config.
+
+    :param config: The `git:` section
+    :return: A line per key that would change
+    """
+
+    def check(key: str) -> str | None:
+        git_key = GIT_SETTINGS[key]
+        result = run(
+            ["git", "config", "--global", "--get", git_key], capture=True, echo=False
+        )
+        current = result.stdout.strip() if result.returncode == 0 else None
+        if current != str(config[key]):
+            return f"{git_key}: {current!r} -> {config[key]!r}"
+        return None
+
+    with ThreadPoolExecutor(max_workers=len(GIT_SETTINGS)) as pool:
+        return [line for line in pool.map(check, GIT_SETTINGS) if line]
+
+
+def plan_fonts(fonts: dict) -> List[str]:
+    nerd_fonts = fonts.get("nerd") or []
+    fontsource_fonts = fonts.get("fontsource") or []
+    return [f"{font} (nerd fonts)" for font in nerd_fonts if not font_exists(font)] + [
+        f"{font} (fontsource)"
+        for font in fontsource_fonts
+        if not font_exists(font.replace(" ", ""))
+    ]
+
+
+def plan_repos(repos: List[dict]) -> List[str]:
+    """
+    Work out which repos would be cloned, and which existing clones would be
+    fast-forwarded (asking the remotes, without fetching).
+
+    :param repos: The `repos:` section
+    :return: A line per repo that would change
+    """
+
+    def check(repo: dict) -> str | None:
+        target_dir = os.path.expanduser(repo["target"])
+        if not os.path.exists(target_dir):
+            return f"clone {repo['src']} into {repo['target']}"
+
+        if not_updatable(target_dir):
+            # update_repo leaves it alone
+            return None
+        moved = upstream_moved(target_dir)
+        if moved is None:
+            return f"fetch {repo['target']} (its remote can't be reached, so it would be left as it is)"
+        if moved:
+            return f"fast-forward {repo['target']}"
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, len(repos))) as pool:
+        return [line for line in pool.map(check, repos) if line]
+
+
+def plan_github_rpms(packages: List[dict]) -> List[str]:
+    return [
+        f"{package['owner']}/{package['repo']}"
+        for package in packages
+        if not is_program_installed(package.get("name") or package["repo"])
+    ]
+
+
+def plan_installed(
+    state: State, section: str, entries: List, missing: Callable[[List], List]
+) -> List:
+    """
+    Plan a section the way bootstrap applies it: the entries the state file
+    says are pending, minus those the probe finds already installed. Forced
+    sections skip the probe, like the installers do.
+
+    :param state: The record of previously applied entries
+    :param section: The bootstrap.yaml section name
+    :param entries: The current entries of that section
+    :param missing: Returns which of the given entries aren't installed
+    :return: The entries that would be installed
+    """
+    pending = state.pending(section, entries or [])
+    if not pending or state.is_forced(section):
+        return pending
+    return missing(pending)
+
+
+def plan_dotfiles(
+    repo_home: str, user_home: str, jobs: int, mode: str = "copy"
+) -> List[str]:
+    """
+    Compare ./home against the home directory the same way copy_dotfiles does.
+
+    :return: A line per file that would be copied or would conflict
+    """
+    manifest = load_manifest(user_home)
+
+    def check(rel_path: str) -> str | None:
+        repo_file = os.path.join(repo_home, rel_path)
+        real_file = os.path.join(user_home, rel_path)
+        if unchanged_since_sync(repo_file, real_file, manifest.get(rel_path), mode):
+            return None
+
+        outcome = classify(repo_file, real_file, mode=mode)
+        if outcome == COPY:
+            return f"{mode} {rel_path}"
+        elif outcome == CONFLICT:
+            return f"conflict {rel_path} (newer in {user_home})"
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        return [line for line in pool.map(check, list_dotfiles(repo_home)) if line]
+
+
+def build_plan(
+    data: dict, state: State, repo_home: str, user_home: str, jobs: int = 8
+) -> Dict[str, List[str]]:
+    """
+    Run every check concurrently and collect what would change.
+
+    mise, npm, go and pip are planned from the state file and then checked
+    against what is installed, the same way bootstrap applies them. dnf
+    repos have no cheap way to inspect the system, so they are planned from
+    the state file of the last run alone.
+
+    :param data: The loaded bootstrap.yaml
+    :param state: The record of previously applied entries
+    :param repo_home: The root path to the dot files
+    :param user_home: The user's home directory
+    :param jobs: Number of checks to run at the same time
+    :return: section -> a line per change
+    """
+    checks = {
+        "groups": lambda: missing_groups(data["groups"] or []),
+        "packages": lambda: missing_packages(data["packages"] or []),
+        "rpm_from_github": lambda: plan_github_rpms(data["rpm_from_github"] or []),
+        "package_repos": lambda: [
+            repo.get("url") or repo.get("file")
+            for repo in state.pending("package_repos", data["package_repos"] or [])
+        ],
+        "git": lambda: plan_git(data["git"]) if data["git"] else [],
+        "repos": lambda: plan_repos(data["repos"] or []),
+        "fonts": lambda: plan_fonts(data["fonts"] or {}),
+        "mise": lambda: plan_installed(state, "mise", data["mise"], missing_tools),
+        "npm_global": lambda: plan_installed(
+            state, "npm_global", data["npm_global"], missing_npm_packages
+        ),
+        "go_install": lambda: plan_installed(
+            state, "go_install", data["go_install"], missing_go_packages
+        ),
+        "pip_global": lambda: plan_installed(
+            state,
+            "pip_global",
+            data["pip_global"],
+            lambda pending: missing_pip_packages(pending, user_scoped=True),
+        ),
+        "dotfiles": lambda: plan_dotfiles(
+            repo_home, user_home, jobs, dotfiles_mode(data)
+        ),
+    }
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = {section: pool.submit(check) for section, check in checks.items()}
+        return {section: future.result() for section, future in futures.items()}
+
+
+def print_plan(data: dict, state: State, repo_home: str, user_home: str, jobs: int = 8):
+    """
+    Build the plan and print it.
+
+    :return:
+    """
+    start = time.monotonic()
+    plan = build_plan(data, state, repo_home, user_home, jobs=jobs)
+
+    for section, changes in plan.items():
+        if not changes:
+            print(f"{section}: up to date")
+            continue
+        print(f"{section}: {len(changes)} change(s)")
+        for change in changes:
+            print(f"  + {change}")
+
+    print(f"\nPlan built in {time.monotonic() - start:.2f}s. Nothing was changed.")
@@ -0,0 +1,113 @@
+"""
+Downloads release artifacts in the background while other stages run.
+
+The prefetch starts as soon as bootstrap.yaml is loaded. It resolves the
+latest release of every `rpm_from_github` entry and the nerd fonts tag, and
+downloads the rpms and font archives into the download cache while the
+dnf update is still running. The install stages fetch the same urls through
+the cache, so they either find the file already there or wait only for the
+download that is still in flight.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+from cache import DownloadCancelled, fetch
+from fonts import (
+    DEFAULT_NERD_FONT_VERSION,
+    FONTSOURCE_HEADERS,
+    font_exists,
+    get_fontsource_download_url,
+    get_latest_nerdfonts_release,
+    nerd_font_url,
+)
+from packages import download_rpm_asset, is_program_installed, resolve_github_rpm
+
+
+def prefetch_tasks(data: dict, skip_installed: bool = True) -> List[Callable[[], str]]:
+    """
+    Build a task for every artifact bootstrap.yaml will download.
+
+    Each task resolves its url (through the cache, so release metadata is
+    only requested once) and downloads it.
+
+    :param data: The loaded bootstrap.yaml
+    :param skip_installed: (optional) Leave out fonts and programs already on this machine
+    :return: Callables that download an artifact and return its url
+    """
+    tasks = []
+    # The release tag is looked up by the first nerd font task and shared with
+    # the rest, so a failing lookup isn't repeated for every font
+    nerd_version = []
+    nerd_version_lock = threading.Lock()
+
+    def nerd_font(font: str) -> str:
+        with nerd_version_lock:
+            if not nerd_version:
+                nerd_version.append(
+                    get_latest_nerdfonts_release() or DEFAULT_NERD_FONT_VERSION
+                )
+        url = nerd_font_url(font, nerd_version[0])
+        fetch(url, immutable=True)
+        return url
+
+    def fontsource_font(font: str) -> str:
+        url = get_fontsource_download_url(font)
+        fetch(url, headers=FONTSOURCE_HEADERS)
+        return url
+
+    def github_rpm(package: dict) -> str | None:
+        asset = resolve_github_rpm(package["owner"], package["repo"])
+        if not asset:
+            return None
+        download_rpm_asset(asset)
+        return asset["browser_download_url"]
+
+    fonts = data["fonts"] or {}
+    for font in fonts.get("nerd") or []:
+        if not (skip_installed and font_exists(font)):
+            tasks.append(lambda font=font: nerd_font(font))
+
+    for font in fonts.get("fontsource") or []:
+        if not (skip_installed and font_exists(font.replace(" ", ""))):
+            tasks.append(lambda font=font: fontsource_font(font))
+
+    for package in data["rpm_from_github"] or []:
+        program = package.get("name") or package["repo"]
+        if not (skip_installed and is_program_installed(program)):
+            tasks.append(lambda package=package: github_rpm(package))
+
+    return tasks
+
+
+def start_prefetch(data: dict, jobs: int = 4) -> ThreadPoolExecutor:
+    """
+    Start downloading every artifact in the background.
+
+    Failures are only reported. The install stage that needs the artifact
+    downloads it again (see cache.fetch) and handles the error itself.
+
+    Call shutdown(cancel_futures=True) on the returned executor once the
+    stages are done, so downloads that haven't started yet are dropped, and
+    cache.cancel_downloads to stop the ones in flight.
+
+    :param data: The loaded bootstrap.yaml
+    :param jobs: Maximum number of downloads at the same time
+    :return: The executor running the downloads
+    """
+
+    def run(task: Callable[[], str]):
+        try:
+            task()
+        except DownloadCancelled:
+            pass
+        except Exception as e:
+            print(f"Prefetch failed, it will be retried when needed: {e}")
+
+    tasks = prefetch_tasks(data)
+    pool = ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix="prefetch")
+    for task in tasks:
+        pool.submit(run, task)
+    print(f"Prefetching {len(tasks)} artifact(s) in the background.")
+    return pool
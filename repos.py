@@ -1,21 +1,150 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
-from utils import cmd
+from utils import CmdResult, cmd, run
 
 
-def download_repo(target: str, src: str):
+def download_repo(target: str, src: str, depth: int = None, filter: str = None):
     """
     Clone the target repo to a location on the filesystem.
 
+    If it has already been cloned it is fast-forwarded instead, as long as
+    it has no local changes or commits (see update_repo).
+
     :param target: The target location on the filesystem where you want to clone the repo
     :param src: The git url (https) that contains the repo you want to clone
+    :param depth: (optional) Only clone this many commits of history
+    :param filter: (optional) A partial clone filter, e.g. "blob:none" to fetch file contents on demand
     :return:
     """
     target_dir = os.path.expanduser(target)
 
     # Check if it exists
     if os.path.exists(target_dir):
-        print(f"{target_dir} already exists. Continuing.")
+        update_repo(target_dir)
+        return
+
+    args = ["git", "clone"]
+    if depth:
+        args += ["--depth", str(depth)]
+    if filter:
+        args += [f"--filter={filter}"]
+    cmd(args + [src, target_dir], error_msg=f"Error fetching '{src}' git repo")
+
+
+def _git(target_dir: str, *args: str) -> CmdResult:
+    return run(["git", "-C", target_dir, *args], capture=True, echo=False)
+
+
+def not_updatable(target_dir: str) -> str | None:
+    """
+    Check whether an existing clone can be fast-forwarded. Only the local
+    repo is looked at, so fetch first to compare against the latest upstream.
+
+    :param target_dir: Path to the existing clone
+    :return: Why the clone has to be left alone, or None if it is clean and
+        not ahead of its upstream
+    """
+    if not os.path.isdir(os.path.join(target_dir, ".git")):
+        return "isn't a git repo"
+
+    status = _git(target_dir, "status", "--porcelain")
+    if status.returncode != 0:
+        return "can't be checked for local changes"
+    if status.stdout.strip():
+        return "has local changes"
+
+    ahead = _git(target_dir, "rev-list", "--count", "@{u}..HEAD")
+    if ahead.returncode != 0 or not ahead.stdout.strip().isdigit():
+        return "has no upstream branch"
+    if int(ahead.stdout):
+        return "has local commits that aren't upstream"
+    return None
+
+
+def upstream_moved(target_dir: str) -> bool | None:
+    """
+    Ask the remote (without fetching) whether the upstream branch points
+    somewhere other than the local HEAD.
+
+    :param target_dir: Path to a clone that not_updatable accepted
+    :return: Whether there is anything to fast-forward, or None if the remote
+        couldn't be reached
+    """
+    branch = _git(target_dir, "symbolic-ref", "-q", "HEAD").stdout.strip()
+    upstream = _git(
+        target_dir,
+        "for-each-ref",
+        "--format=%(upstream:remotename) %(upstream:remoteref)",
+        branch,
+    ).stdout.split()
+    if len(upstream) != 2:
+        return None
+    head = _git(target_dir, "rev-parse", "HEAD").stdout.strip()
+
+    remote = _git(target_dir, "ls-remote", "--exit-code", *upstream)
+    if remote.returncode != 0 or not remote.stdout:
+        return None
+    return remote.stdout.split()[0] != head
+
+
+def update_repo(target_dir: str):
+    """
+    Fetch and fast-forward an existing clone. Repos with local changes or
+    commits, without an upstream, or that aren't git repos at all, are left
+    alone. Failing to fetch or fast-forward is only a warning.
+
+    :param target_dir: Path to the existing clone
+    :return:
+    """
+    if not os.path.isdir(os.path.join(target_dir, ".git")):
+        print(f"{target_dir} already exists and isn't a git repo. Continuing.")
         return
 
-    cmd(["git", "clone", src, target_dir], error_msg=f"Error fetching '{src}' git repo")
+    fetch = run(["git", "-C", target_dir, "fetch", "--quiet"])
+    if fetch.timed_out or fetch.returncode != 0:
+        print(f"Warning: couldn't fetch '{target_dir}'. Not updating.")
+        return
+
+    reason = not_updatable(target_dir)
+    if reason:
+        print(f"{target_dir} {reason}. Not updating.")
+        return
+
+    merge = run(["git", "-C", target_dir, "merge", "--ff-only", "--quiet", "@{u}"])
+    if merge.timed_out or merge.returncode != 0:
+        print(f"Warning: couldn't fast-forward '{target_dir}'. Not updating.")
+
+
+def download_repos(repos: List[dict], jobs: int = 4):
+    """
+    Clone or update every entry of the `repos:` section concurrently.
+
+    Each entry needs `target` and `src`, and can set `depth` and `filter`
+    (see download_repo). A failing clone doesn't stop the others, and
+    existing clones that can't be updated are only warned about.
+
+    :param repos: The `repos:` section
+    :param jobs: Maximum number of repos to clone at the same time
+    :return:
+    """
+
+    def sync(repo: dict) -> str | None:
+        try:
+            download_repo(
+                repo["target"],
+                repo["src"],
+                depth=repo.get("depth"),
+                filter=repo.get("filter"),
+            )
+        except Exception as e:
+            print(e)
+            return repo["src"]
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        failed = [src for src in pool.map(sync, repos) if src]
+
+    if failed:
+        raise Exception(f"Failed to sync repos: {', '.join(failed)}")
@@ -0,0 +1,109 @@
+"""
+Runs the bootstrap stages as a dependency graph.
+
+Each stage declares the stages it needs and the locks it takes. Stages
+whose dependencies are done run in parallel (up to `jobs` at a time),
+except that two stages holding the same lock (e.g. "dnf") never overlap.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List
+
+from tracing import span
+
+
+@dataclass
+class Stage:
+    name: str
+    func: Callable[[], None]
+    needs: List[str] = field(default_factory=list)
+    locks: List[str] = field(default_factory=list)
+
+
+def validate_stages(stages: List[Stage]):
+    """
+    Make sure every dependency exists and that the graph has no cycles.
+
+    :param stages: The stages to validate
+    :return:
+    """
+    by_name = {stage.name: stage for stage in stages}
+    assert len(by_name) == len(stages), "Duplicate stage names defined."
+
+    for stage in stages:
+        for need in stage.needs:
+            assert need in by_name, f"Stage '{stage.name}' needs unknown stage '{need}'"
+
+    # Kahn's algorithm, anything left over is part of a cycle
+    remaining = {stage.name: set(stage.needs) for stage in stages}
+    while remaining:
+        ready = [name for name, needs in remaining.items() if not needs]
+        assert ready, f"Dependency cycle between stages: {sorted(remaining)}"
+        for name in ready:
+            del remaining[name]
+        for needs in remaining.values():
+            needs.difference_update(ready)
+
+
+def run_stage(stage: Stage):
+    with span(stage.name, "stage"):
+        stage.func()
+
+
+def run_stages(stages: List[Stage], jobs: int = 4):
+    """
+    Run the stages, starting each as soon as its dependencies have finished.
+
+    If a stage fails no new stages are started. Stages that are already
+    running are allowed to finish before the failure is raised.
+
+    :param stages: The stages to run
+    :param jobs: Maximum number of stages to run at the same time
+    :return:
+    """
+    assert jobs >= 1, f"At least one stage has to run at a time, got jobs={jobs}"
+    validate_stages(stages)
+
+    pending: Dict[str, Stage] = {stage.name: stage for stage in stages}
+    running = {}
+    held_locks = set()
+    done = set()
+    failed = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            if not failed:
+                for name, stage in list(pending.items()):
+                    if len(running) >= jobs:
+                        break
+                    if not all(need in done for need in stage.needs):
+                        continue
+                    if held_locks.intersection(stage.locks):
+                        continue
+
+                    del pending[name]
+                    held_locks.update(stage.locks)
+                    print(f"==> Starting {name}")
+                    running[pool.submit(run_stage, stage)] = stage
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                held_locks.difference_update(stage.locks)
+
+                error = future.exception()
+                if error:
+                    print(f"==> {stage.name} failed: {error}")
+                    failed[stage.name] = error
+                else:
+                    print(f"==> Finished {stage.name}")
+                    done.add(stage.name)
+
+    if failed:
+        if pending:
+            print(f"Skipped stages: {', '.join(pending)}")
+        raise Exception(f"Bootstrap stopped after failed stage(s): {', '.join(failed)}")
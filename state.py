@@ -0,0 +1,145 @@
+"""
+Keeps track of what bootstrap has already applied.
+
+For each section of bootstrap.yaml the state file records a fingerprint of
+every entry along with whether it was applied successfully. On the next
+run only entries that are new, have changed, or failed last time are
+applied again. Sections can be forced to re-run in full.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from typing import Callable, Iterable, List
+
+STATE_FILE = os.path.expanduser("~/.local/state/dots/bootstrap.json")
+
+
+def fingerprint(entry) -> str:
+    """
+    Create a stable hash of a config entry.
+
+    :param entry: Any json serializable config value
+    :return: A hex digest of the entry
+    """
+    encoded = json.dumps(entry, sort_keys=True).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class State:
+    def __init__(self, path: str = STATE_FILE, force: Iterable[str] = ()):
+        """
+        :param path: (optional) Where the state is persisted
+        :param force: (optional) Sections to re-apply in full. "all" forces every section.
+        """
+        self.path = path
+        self.force = set(force)
+        self._lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self._sections = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self._sections = {}
+
+    def is_forced(self, section: str) -> bool:
+        return "all" in self.force or section in self.force
+
+    def pending(self, section: str, entries: List) -> List:
+        """
+        Find the entries of a section that still need to be applied.
+
+        :param section: The bootstrap.yaml section name
+        :param entries: The current entries of that section
+        :return: The entries that are new, changed, or failed last time
+        """
+        if self.is_forced(section):
+            return list(entries)
+
+        with self._lock:
+            applied = self._sections.get(section, {})
+            return [entry for entry in entries if applied.get(fingerprint(entry)) is not True]
+
+    def record(self, section: str, entries: List, ok: bool):
+        """
+        Store the outcome of applying entries and persist the state file.
+
+        :param section: The bootstrap.yaml section name
+        :param entries: The entries that were applied
+        :param ok: Whether applying them succeeded
+        :return:
+        """
+        with self._lock:
+            applied = self._sections.setdefault(section, {})
+            for entry in entries:
+                applied[fingerprint(entry)] = ok
+            self._save()
+
+    def prune(self, section: str, entries: List):
+        """
+        Forget entries that have been removed from bootstrap.yaml.
+
+        :param section: The bootstrap.yaml section name
+        :param entries: The current entries of that section
+        :return:
+        """
+        current = {fingerprint(entry) for entry in entries}
+        with self._lock:
+            applied = self._sections.get(section, {})
+            for key in set(applied) - current:
+                del applied[key]
+            self._save()
+
+    def run_each(self, section: str, entries: List, func: Callable):
+        """
+        Apply the pending entries of a section one at a time.
+
+        :param section: The bootstrap.yaml section name
+        :param entries: The current entries of that section
+        :param func: Called with each pending entry
+        :return:
+        """
+        entries = entries or []
+        self.prune(section, entries)
+        pending = self.pending(section, entries)
+        if not pending:
+            print(f"{section} is up to date. Skipping.")
+            return
+
+        for entry in pending:
+            try:
+                func(entry)
+            except Exception:
+                self.record(section, [entry], False)
+                raise
+            self.record(section, [entry], True)
+
+    def run_batch(self, section: str, entries: List, func: Callable):
+        """
+        Apply all pending entries of a section with a single call.
+
+        :param section: The bootstrap.yaml section name
+        :param entries: The current entries of that section
+        :param func: Called once with the list of pending entries
+        :return:
+        """
+        entries = entries or []
+        self.prune(section, entries)
+        pending = self.pending(section, entries)
+        if not pending:
+            print(f"{section} is up to date. Skipping.")
+            return
+
+        try:
+            func(pending)
+        except Exception:
+            self.record(section, pending, False)
+            raise
+        self.record(section, pending, True)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._sections, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
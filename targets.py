@@ -0,0 +1,246 @@
+"""
+Deploys ./home to many home directories at once, e.g. for several dev users
+or container home directories.
+
+> ./dots.py --target /home/alice --target /srv/containers/web/home
+
+The source tree is walked and hashed once. Every target is then synced in
+its own process, using its own manifest, so only the target files are read.
+When run as root, each target is deployed by a fresh process that has
+switched to the user and group owning the target directory. Everything is
+written with that user's permissions, so files end up owned by them and
+symlinks they control can't redirect writes outside their home. That user
+needs to be able to read ./home.
+
+Conflicts (files that are newer in the target) are settled by a policy
+instead of asking:
+
+- newer: keep the newer file in the target (the default)
+- overwrite: deploy the file from ./home anyway
+- report: leave the file alone and report it as a conflict
+"""
+
+import contextlib
+import io
+import os
+import pwd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Tuple
+
+from dots import (
+    CONFLICT,
+    COPY,
+    DEPLOY_MODES,
+    IDENTICAL,
+    classify,
+    deploy_files,
+    file_hash,
+    list_dotfiles,
+    load_manifest,
+    recover_journal,
+    save_manifest,
+    synced_entry,
+    unchanged_since_sync,
+)
+
+POLICIES = ("newer", "overwrite", "report")
+# Threads each target process uses to write its files
+THREADS_PER_TARGET = 4
+
+
+def scan_source(repo_home: str, jobs: int = 8) -> dict:
+    """
+    Walk and hash the dotfiles repo once, so the targets don't have to.
+
+    :param repo_home: The root path to the dot files
+    :param jobs: Number of files to hash at the same time
+    :return: relative path -> sha256
+    """
+    rel_paths = list_dotfiles(repo_home)
+
+    def hash_file(rel_path: str) -> str:
+        return file_hash(os.path.join(repo_home, rel_path))
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        return dict(zip(rel_paths, pool.map(hash_file, rel_paths)))
+
+
+def target_owner(user_home: str) -> Tuple[int, int] | None:
+    """
+    :param user_home: The target home directory
+    :return: (uid, gid) to deploy as when running as root for another user,
+        otherwise None
+    """
+    if os.geteuid() != 0:
+        return None
+    st = os.stat(user_home)
+    if st.st_uid == 0:
+        return None
+    return st.st_uid, st.st_gid
+
+
+def drop_privileges(owner: Tuple[int, int]):
+    """
+    Permanently switch the current process to another user and group,
+    including their supplementary groups.
+
+    :param owner: (uid, gid)
+    :return:
+    """
+    uid, gid = owner
+    try:
+        os.initgroups(pwd.getpwuid(uid).pw_name, gid)
+    except KeyError:
+        # No passwd entry, e.g. a container's home directory
+        os.setgroups([])
+    os.setresgid(gid, gid, gid)
+    os.setresuid(uid, uid, uid)
+
+
+def deploy_target(
+    repo_home: str, user_home: str, source: dict, mode: str, policy: str
+) -> dict:
+    """
+    Sync one target without asking anything. Runs in a worker process, which
+    switches to the target's owner when running as root (see target_owner).
+
+    :param repo_home: The root path to the dot files
+    :param user_home: The target home directory
+    :param source: The result of scan_source
+    :param mode: One of DEPLOY_MODES
+    :param policy: One of POLICIES
+    :return: A report of what was done to the target
+    """
+    report = {
+        "target": user_home,
+        "deployed": [],
+        "overwritten": [],
+        "kept": [],
+        "conflicts": [],
+        "unchanged": 0,
+        "error": None,
+    }
+
+    try:
+        owner = target_owner(user_home)
+        if owner:
+            drop_privileges(owner)
+            if not os.access(repo_home, os.R_OK | os.X_OK):
+                raise PermissionError(f"uid {owner[0]} can't read {repo_home}")
+
+        # Per file output from the different targets would be interleaved,
+        # the report covers it instead
+        with contextlib.redirect_stdout(io.StringIO()):
+            _deploy_target(repo_home, user_home, source, mode, policy, report)
+    except Exception as e:
+        report["error"] = str(e)
+    return report
+
+
+def _deploy_target(
+    repo_home: str, user_home: str, source: dict, mode: str, policy: str, report: dict
+):
+    recover_journal(user_home)
+    manifest = load_manifest(user_home)
+
+    copies = []
+    try:
+        for rel_path, sha256 in source.items():
+            repo_file = os.path.join(repo_home, rel_path)
+            real_file = os.path.join(user_home, rel_path)
+            if unchanged_since_sync(repo_file, real_file, manifest.get(rel_path), mode):
+                report["unchanged"] += 1
+                continue
+
+            outcome = classify(repo_file, real_file, mode=mode, repo_sha256=sha256)
+            if outcome == IDENTICAL:
+                report["unchanged"] += 1
+                manifest[rel_path] = synced_entry(repo_file, real_file, mode, sha256)
+            elif outcome == COPY:
+                copies.append(rel_path)
+                report["deployed"].append(rel_path)
+            elif outcome == CONFLICT and policy == "overwrite":
+                copies.append(rel_path)
+                report["overwritten"].append(rel_path)
+            elif outcome == CONFLICT and policy == "newer":
+                report["kept"].append(rel_path)
+            else:
+                report["conflicts"].append(rel_path)
+
+        deploy_files(repo_home, user_home, copies, mode, THREADS_PER_TARGET)
+        for rel_path in copies:
+            manifest[rel_path] = synced_entry(
+                os.path.join(repo_home, rel_path),
+                os.path.join(user_home, rel_path),
+                mode,
+                source[rel_path],
+            )
+    finally:
+        save_manifest(user_home, manifest)
+
+
+def deploy_targets(
+    repo_home: str,
+    user_homes: List[str],
+    mode: str = "copy",
+    policy: str = "newer",
+    jobs: int = 4,
+) -> List[dict]:
+    """
+    Deploy the dotfiles repo to several home directories concurrently.
+
+    A target that fails doesn't stop the others, its report has the error.
+    Targets that resolve to the same directory are only deployed once.
+
+    :param repo_home: The root path to the dot files
+    :param user_homes: The target home directories
+    :param mode: (optional) How to deploy files, one of DEPLOY_MODES
+    :param policy: (optional) How to settle conflicts, one of POLICIES
+    :param jobs: (optional) Number of targets to deploy at the same time
+    :return: A report per distinct target, in the same order as user_homes
+    """
+    assert mode in DEPLOY_MODES, f"Unknown deploy mode '{mode}'"
+    assert policy in POLICIES, f"Unknown conflict policy '{policy}'"
+
+    # Absolute paths, so symlinks and the journal don't depend on the worker's cwd
+    repo_home = os.path.abspath(repo_home)
+    # Two processes deploying to the same directory would race on its temp files
+    user_homes = list({os.path.realpath(home): None for home in user_homes})
+    source = scan_source(repo_home)
+
+    # As root, workers give up their privileges for their target, so each
+    # target needs a fresh process
+    with ProcessPoolExecutor(
+        max_workers=max(1, min(jobs, len(user_homes))),
+        max_tasks_per_child=1 if os.geteuid() == 0 else None,
+    ) as pool:
+        futures = [
+            pool.submit(deploy_target, repo_home, home, source, mode, policy)
+            for home in user_homes
+        ]
+        return [future.result() for future in futures]
+
+
+def print_reports(reports: List[dict]):
+    """
+    Print a summary per target, listing any files that need attention.
+
+    :param reports: The result of deploy_targets
+    :return:
+    """
+    for report in reports:
+        if report["error"]:
+            print(f"{report['target']}: failed: {report['error']}")
+            continue
+
+        print(
+            f"{report['target']}: {len(report['deployed'])} deployed, "
+            f"{len(report['overwritten'])} overwritten, {report['unchanged']} unchanged, "
+            f"{len(report['kept'])} kept (newer), {len(report['conflicts'])} conflicts"
+        )
+        for rel_path in report["overwritten"]:
+            print(f"  overwrote {rel_path}")
+        for rel_path in report["kept"]:
+            print(f"  kept newer {rel_path}")
+        for rel_path in report["conflicts"]:
+            print(f"  conflict {rel_path}")
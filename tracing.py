@@ -0,0 +1,221 @@
+"""
+Lightweight instrumentation for bootstrap runs.
+
+Stages, subprocesses and HTTP requests are recorded as spans with their
+duration, exit status and how many bytes they downloaded or wrote to disk.
+Bytes are also added up on the stage the span belongs to, including
+spans opened in worker threads the stage started with propagate().
+Spans can be exported in the Chrome trace event format (open the file in
+chrome://tracing or https://ui.perfetto.dev) and summarised as a table.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable, List
+
+_lock = threading.Lock()
+_local = threading.local()
+_spans: List["Span"] = []
+_epoch = time.perf_counter()
+
+
+@dataclass
+class Span:
+    name: str
+    cat: str
+    start: float
+    end: float = 0.0
+    tid: int = 0
+    args: dict = field(default_factory=dict)
+    # The span this one was opened in, possibly on another thread
+    parent: "Span | None" = field(default=None, repr=False)
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+def _stack() -> List[Span]:
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _current() -> Span | None:
+    """
+    The innermost open span of this thread, or the span the thread's work
+    was handed over from (see propagate).
+    """
+    stack = _stack()
+    return stack[-1] if stack else getattr(_local, "parent", None)
+
+
+def propagate(func: Callable) -> Callable:
+    """
+    Wrap a function that will run on another thread (e.g. in a thread pool)
+    so the spans and bytes it records count towards the span open here.
+
+    :param func: The function to wrap
+    :return: The wrapped function
+    """
+    parent = _current()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, "parent", None)
+        _local.parent = parent
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.parent = previous
+
+    return wrapper
+
+
+@contextmanager
+def span(name: str, cat: str, **args):
+    """
+    Record how long the wrapped block takes.
+
+    An exception escaping the block marks the span as failed.
+
+    :param name: What is being done, e.g. the stage name or url
+    :param cat: The kind of span, e.g. "stage", "subprocess" or "http"
+    :param args: Extra details to attach to the span
+    :return: The span, so details such as the exit status can be added
+    """
+    current = Span(
+        name=name,
+        cat=cat,
+        start=time.perf_counter(),
+        tid=threading.get_ident(),
+        args=dict(args),
+        parent=_current(),
+    )
+    _stack().append(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.args.setdefault("status", f"error: {e}")
+        raise
+    finally:
+        current.end = time.perf_counter()
+        _stack().pop()
+        with _lock:
+            _spans.append(current)
+
+
+def add_bytes(key: str, count: int):
+    """
+    Add to a byte counter (e.g. "bytes_downloaded") on the innermost open span
+    of the current thread, and on the stage it belongs to. Does nothing if
+    there is no open span.
+
+    :param key: The counter name
+    :param count: Number of bytes to add
+    :return:
+    """
+    current = _current()
+    stage = current
+    while stage is not None and stage.cat != "stage":
+        stage = stage.parent
+
+    with _lock:
+        if current is not None:
+            current.args[key] = current.args.get(key, 0) + count
+        if stage is not None and stage is not current:
+            stage.args[key] = stage.args.get(key, 0) + count
+
+
+def spans() -> List[Span]:
+    with _lock:
+        return list(_spans)
+
+
+def write_chrome_trace(path: str):
+    """
+    Write every finished span to a file in the Chrome trace event format.
+
+    :param path: Where to write the json file
+    :return:
+    """
+    events = [
+        {
+            "name": s.name,
+            "cat": s.cat,
+            "ph": "X",
+            "ts": (s.start - _epoch) * 1_000_000,
+            "dur": s.duration * 1_000_000,
+            "pid": os.getpid(),
+            "tid": s.tid,
+            "args": s.args,
+        }
+        for s in spans()
+    ]
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def _format_bytes(count: int) -> str:
+    if not count:
+        return ""
+    for unit in ("B", "KiB", "MiB"):
+        if count < 1024:
+            return f"{count:.0f}{unit}" if unit == "B" else f"{count:.1f}{unit}"
+        count /= 1024
+    return f"{count:.1f}GiB"
+
+
+def print_summary():
+    """
+    Print a table with the time taken and bytes moved by each stage, followed
+    by totals for every other kind of span.
+
+    :return:
+    """
+    recorded = spans()
+    if not recorded:
+        return
+
+    rows = [
+        (
+            s.name,
+            s.duration,
+            s.args.get("status", "ok"),
+            _format_bytes(s.args.get("bytes_downloaded", 0)),
+            _format_bytes(s.args.get("bytes_written", 0)),
+        )
+        for s in sorted(recorded, key=lambda s: s.start)
+        if s.cat == "stage"
+    ]
+
+    totals = defaultdict(lambda: [0, 0.0, 0, 0])
+    for s in recorded:
+        if s.cat == "stage":
+            continue
+        total = totals[s.cat]
+        total[0] += 1
+        total[1] += s.duration
+        total[2] += s.args.get("bytes_downloaded", 0)
+        total[3] += s.args.get("bytes_written", 0)
+    for cat, (count, duration, downloaded, written) in sorted(totals.items()):
+        rows.append(
+            (
+                f"{cat} (x{count})",
+                duration,
+                "",
+                _format_bytes(downloaded),
+                _format_bytes(written),
+            )
+        )
+
+    width = max(len(row[0]) for row in rows)
+    print(f"\n{'span':<{width}}  {'time':>9}  {'downloaded':>10}  {'written':>10}  status")
+    for name, duration, status, downloaded, written in rows:
+        print(f"{name:<{width}}  {duration:>8.1f}s  {downloaded:>10}  {written:>10}  {status}")
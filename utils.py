@@ -1,21 +1,136 @@
+import os
+import shlex
+import signal
 import subprocess
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
 from typing import List
 
+from tracing import span
 
-def cmd(args: List[str], error_msg=None) -> str:
+# Downloads are read in chunks of this size so memory use stays flat
+CHUNK_SIZE = 1024 * 1024
+# How many lines of stderr are kept around to report when a command fails
+STDERR_TAIL_LINES = 50
+
+
+@dataclass
+class CmdResult:
+    args: List[str]
+    returncode: int
+    duration: float
+    # Only filled in when the command was run with capture=True
+    stdout: str = ""
+    stderr_tail: List[str] = field(default_factory=list)
+    timed_out: bool = False
+
+
+def run(
+    args: List[str], timeout: float = None, capture=False, echo=True
+) -> CmdResult:
     """
-    Execute a command line operation.
+    Run a command, streaming its output line by line as it is produced.
+
+    Output isn't buffered, apart from the last STDERR_TAIL_LINES lines of
+    stderr for error reports (and stdout when capture is set, which should
+    only be used for commands with small output).
 
     :param args: A list of arguments to run. e.g. ["ls", "-latr"]
-    :param error_msg: (optional) An additional error message to include in the event of a failure.
-    :return: The stdout response from the command
+    :param timeout: (optional) Seconds to wait before killing the command and
+        everything it started
+    :param capture: (optional) Keep stdout so it can be returned
+    :param echo: (optional) Print the output, wall time and exit status to the console
+    :return: The result, regardless of the exit status
     """
-    result = subprocess.run(
+    with span(shlex.join(args), "subprocess") as current:
+        result = _run(args, timeout, capture, echo)
+        current.args["exit_status"] = "timeout" if result.timed_out else result.returncode
+    return result
+
+
+def _run(args: List[str], timeout: float, capture: bool, echo: bool) -> CmdResult:
+    start = time.monotonic()
+    proc = subprocess.Popen(
         args,
-        capture_output=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
         text=True,
+        errors="replace",
+        # With a timeout the command gets its own process group, so that
+        # whatever it started (e.g. `bash -c "curl ... | sh"`, sudo) is killed
+        # with it. Without one it stays attached to the terminal so sudo can
+        # still prompt for a password.
+        start_new_session=timeout is not None,
     )
+
+    stdout_lines = []
+    stderr_tail = deque(maxlen=STDERR_TAIL_LINES)
+
+    def pump(stream, is_stderr: bool):
+        for line in stream:
+            if is_stderr:
+                stderr_tail.append(line)
+            elif capture:
+                stdout_lines.append(line)
+            if echo:
+                print(line, end="", flush=True)
+        stream.close()
+
+    pumps = [
+        threading.Thread(target=pump, args=(proc.stdout, False), daemon=True),
+        threading.Thread(target=pump, args=(proc.stderr, True), daemon=True),
+    ]
+    for pump_thread in pumps:
+        pump_thread.start()
+
+    timed_out = False
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+    for pump_thread in pumps:
+        pump_thread.join()
+
+    result = CmdResult(
+        args=args,
+        returncode=proc.returncode,
+        duration=time.monotonic() - start,
+        stdout="".join(stdout_lines),
+        stderr_tail=list(stderr_tail),
+        timed_out=timed_out,
+    )
+    if echo:
+        status = "timed out" if timed_out else f"exited with {result.returncode}"
+        print(f"$ {shlex.join(args)} {status} after {result.duration:.1f}s")
+    return result
+
+
+def cmd(
+    args: List[str], error_msg=None, timeout: float = None, capture=False, echo=True
+) -> str:
+    """
+    Execute a command line operation.
+
+    :param args: A list of arguments to run. e.g. ["ls", "-latr"]
+    :param error_msg: (optional) An additional error message to include in the event of a failure.
+    :param timeout: (optional) Seconds to wait before killing the command and everything it started
+    :param capture: (optional) Keep and return stdout. Only use this for small outputs.
+    :param echo: (optional) Stream the output to the console
+    :return: The stdout response from the command when capture is set
+    """
+    result = run(args, timeout=timeout, capture=capture, echo=echo)
+    if (result.timed_out or result.returncode != 0) and not echo:
+        # Otherwise it was already streamed to the console
+        print("".join(result.stderr_tail))
+    if result.timed_out:
+        raise Exception(f"Timed out after {timeout}s.\n{error_msg}")
     if result.returncode != 0:
-        print(result.stderr)
         raise Exception(f"Received return code {result.returncode}.\n{error_msg}")
     return result.stdout
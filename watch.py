@@ -0,0 +1,290 @@
+"""
+Keeps $HOME in sync with ./home while files are being edited.
+
+> ./dots.py --watch
+
+Changes under ./home are picked up with inotify, or by polling the stat
+details of every file where inotify isn't available. Only the paths that
+changed are synced. Bursts of events (editors often write a temp file and
+rename it over the original) are debounced into one batch.
+
+Deleting or renaming a file in ./home removes the deployed copy, but only
+if it still matches what was last deployed. Files that are newer in $HOME
+are reported and left alone, run ./dots.py to resolve them.
+"""
+
+import ctypes
+import os
+import select
+import struct
+import time
+from typing import Set
+
+from dots import (
+    CONFLICT,
+    list_dotfiles,
+    load_manifest,
+    recover_journal,
+    save_manifest,
+    stat_key,
+    sync_file,
+)
+
+# How long to wait for a burst of events to settle before syncing
+DEBOUNCE = 0.05
+# Sync anyway after this long, even if events keep arriving
+MAX_DELAY = 1.0
+# How often the polling fallback checks for changes
+POLL_INTERVAL = 1.0
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_EVENT = struct.Struct("iIII")
+
+WATCH_MASK = (
+    IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+
+
+class InotifyWatcher:
+    """
+    Watches every directory under root with inotify.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs = {}
+        self._add_tree(root)
+
+    def _add_tree(self, path: str):
+        for dir_path, _, _ in os.walk(path):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"Can't watch {dir_path}")
+            self.dirs[wd] = dir_path
+
+    def read(self, timeout: float | None) -> Set[str] | None:
+        """
+        Wait for events.
+
+        :param timeout: Seconds to wait, or None to wait until something changes
+        :return: Paths relative to root that changed, or None if events were
+            lost and everything needs checking
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+
+        changed = set()
+        buffer = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = IN_EVENT.unpack_from(buffer, offset)
+            offset += IN_EVENT.size
+            name = os.fsdecode(buffer[offset : offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            if wd not in self.dirs or not name:
+                continue
+
+            path = os.path.join(self.dirs[wd], name)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self._add_tree(path)
+                except FileNotFoundError:
+                    pass
+            changed.add(os.path.relpath(path, self.root))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Finds changes by comparing the stat details of every file under root.
+    """
+
+    def __init__(self, root: str, interval: float = POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self) -> dict:
+        snapshot = {}
+        for rel_path in list_dotfiles(self.root):
+            try:
+                snapshot[rel_path] = stat_key(os.path.join(self.root, rel_path))
+            except FileNotFoundError:
+                pass
+        return snapshot
+
+    def read(self, timeout: float | None) -> Set[str] | None:
+        while True:
+            time.sleep(self.interval if timeout is None else timeout)
+            snapshot = self._scan()
+            changed = {
+                rel_path
+                for rel_path in snapshot.keys() | self.snapshot.keys()
+                if snapshot.get(rel_path) != self.snapshot.get(rel_path)
+            }
+            self.snapshot = snapshot
+            if changed or timeout is not None:
+                return changed
+
+    def close(self):
+        pass
+
+
+def make_watcher(root: str):
+    """
+    Use inotify if it's available, otherwise fall back to polling.
+    """
+    try:
+        return InotifyWatcher(root)
+    except (AttributeError, OSError) as e:
+        print(f"inotify isn't available ({e}), polling every {POLL_INTERVAL}s instead.")
+        return PollingWatcher(root)
+
+
+def remove_deployed(user_home: str, rel_path: str, manifest: dict):
+    """
+    Remove the deployed copies of a file or directory that was deleted from
+    the dotfiles repo. Copies that were changed since they were deployed are
+    kept.
+
+    :param user_home: The user's home directory
+    :param rel_path: Relative path of what was deleted
+    :param manifest: The sync manifest to update
+    :return:
+    """
+    removed = [
+        key
+        for key in manifest
+        if key == rel_path or key.startswith(rel_path + os.sep)
+    ]
+    for key in removed:
+        real_file = os.path.join(user_home, key)
+        entry = manifest.pop(key)
+        try:
+            if entry.get("mode") == "symlink" and os.path.islink(real_file):
+                # Points at the deleted file, so there is nothing to lose
+                os.remove(real_file)
+                print(f"Removed {real_file}")
+                continue
+            if stat_key(real_file) != entry["dst"]:
+                print(f"{real_file} changed since it was deployed. Leaving it.")
+                continue
+            os.remove(real_file)
+            print(f"Removed {real_file}")
+        except FileNotFoundError:
+            pass
+
+
+def apply_changes(
+    repo_home: str, user_home: str, rel_paths: Set[str], manifest: dict, mode: str = "copy"
+):
+    """
+    Sync the given paths without asking anything. Conflicts are only reported.
+
+    :param repo_home: The root path to the dot files
+    :param user_home: The user's home directory
+    :param rel_paths: Changed files or directories, relative to repo_home
+    :param manifest: The sync manifest to update
+    :param mode: (optional) How to deploy files, one of DEPLOY_MODES
+    :return:
+    """
+    for rel_path in sorted(rel_paths):
+        repo_path = os.path.join(repo_home, rel_path)
+        if os.path.isdir(repo_path):
+            files = [os.path.join(rel_path, f) for f in list_dotfiles(repo_path)]
+        elif os.path.isfile(repo_path):
+            files = [rel_path]
+        else:
+            remove_deployed(user_home, rel_path, manifest)
+            continue
+
+        for file in files:
+            real_file = os.path.join(user_home, file)
+            try:
+                outcome, entry = sync_file(
+                    os.path.join(repo_home, file),
+                    real_file,
+                    manifest.get(file),
+                    False,
+                    mode,
+                )
+            except FileNotFoundError:
+                # Removed again before we got to it, the event for that follows
+                continue
+            if entry:
+                manifest[file] = entry
+            if outcome == CONFLICT:
+                print(f"{real_file} is newer than the dotfiles repo. Run ./dots.py to resolve.")
+
+
+def watch(repo_home: str, user_home: str, mode: str = "copy"):
+    """
+    Sync everything once, then keep syncing whatever changes until interrupted.
+
+    :param repo_home: The root path to the dot files
+    :param user_home: The user's home directory
+    :param mode: (optional) How to deploy files, one of DEPLOY_MODES
+    :return:
+    """
+    watcher = make_watcher(repo_home)
+    recover_journal(user_home)
+    manifest = load_manifest(user_home)
+    try:
+        # Catch up on anything that changed while nobody was watching
+        apply_changes(
+            repo_home, user_home, set(list_dotfiles(repo_home)), manifest, mode
+        )
+        save_manifest(user_home, manifest)
+        print(f"Watching {repo_home} for changes. Press Ctrl-C to stop.")
+
+        while True:
+            changed = watcher.read(None)
+            deadline = time.monotonic() + MAX_DELAY
+            while changed is not None and time.monotonic() < deadline:
+                more = watcher.read(DEBOUNCE)
+                if not more:
+                    if more is None:
+                        changed = None
+                    break
+                changed |= more
+
+            if changed is None:
+                print("Missed some events, checking every file.")
+                changed = set(list_dotfiles(repo_home)) | set(manifest)
+            apply_changes(repo_home, user_home, changed, manifest, mode)
+            save_manifest(user_home, manifest)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        save_manifest(user_home, manifest)